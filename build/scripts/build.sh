@@ -20,8 +20,6 @@ IFS=@ read -r task subarch distro version <<< "$1"
 SRC="${SRC/#\~/$HOME}"
 SRC=$(realpath "$SRC")
 
-alternate_binds=$(get_alternate_binds)
-
 arch=$subarch
 if [[ "$subarch" == "alpha" ]]; then
     cross="alpha-linux-gnu-"
@@ -71,24 +69,18 @@ else
     exit 1
 fi
 
-cmd="$DOCKER run --rm "
-
-if [[ -t 0 ]]; then
-    cmd+="-it "
-fi
-
-cmd+="-h $(hostname) "
-cmd+="--network none "
-cmd+="-w /linux "
-cmd+="-v $SRC:/linux:ro "
-
-cmd+="$alternate_binds "
+# Per build options, the container options are added below
+cmd="-w /linux "
 cmd+="-e ARCH=$arch "
 
 if [[ -n $JFACTOR ]]; then
     cmd+="-e JFACTOR=$JFACTOR "
 fi
 
+if [[ -n $JOBSERVER ]]; then
+    cmd+="-e JOBSERVER=/jobserver "
+fi
+
 if [[ -n $INSTALL ]]; then
     cmd+="-e INSTALL=$INSTALL "
 fi
@@ -121,6 +113,10 @@ if [[ -n $MODULES ]]; then
     cmd+="-e MODULES=$MODULES "
 fi
 
+if [[ -n $MODULES_FORMAT ]]; then
+    cmd+="-e MODULES_FORMAT=$MODULES_FORMAT "
+fi
+
 if [[ -n $cross ]]; then
     cmd+="-e CROSS_COMPILE=$cross "
 fi
@@ -191,13 +187,10 @@ output_dir=$(get_output_dir "$script_base" "$subarch" "$distro" "$version" "$tas
 output_symlink=$(get_output_dir "$script_base" "$subarch" "$distro" "$version" "$task" "$DEFCONFIG" "$TARGETS" "$CLANG" "symlink")
 mkdir -p "$output_dir" || exit 1
 
-cmd+="-v $output_dir:/output:rw "
-
 user=$(stat -c "%u:%g" $output_dir)
 cmd+="-u $user "
 
 if [[ -n "$CCACHE" ]]; then
-    cmd+="-v $CCACHE:/ccache "
     cmd+="-e CCACHE_DIR=/ccache "
     cmd+="-e CCACHE=1 "
 fi
@@ -206,27 +199,96 @@ if [[ -r /etc/timezone ]]; then
     cmd+="-e TZ=$(< /etc/timezone) "
 fi
 
-if [[ -n "$DOCKER_EXTRA_ARGS" ]]; then
-    # Can be used for eg. a rootdisk.
-    # DOCKER_EXTRA_ARGS="-v /path/to/rootdisk:/path/to/rootdisk:ro"
-    cmd+="$DOCKER_EXTRA_ARGS "
+if [[ -t 0 ]]; then
+    cmd="-it $cmd"
 fi
 
-cmd+="$PODMAN_OPTS "
+if [[ -n "$CONTAINER" ]]; then
+    # Run in a long lived container started by container.sh, which already
+    # has everything mounted, with the output directory at the same path.
+    cmd="$DOCKER exec $cmd"
+    cmd+="-e OUTPUT_DIR=$output_dir "
+
+    # exec doesn't pass signals on to what it runs, so tag the build's
+    # processes via their environment, for stop_build() to find them.
+    build_tag="build-$$"
+    cmd+="-e BUILD_TAG=$build_tag "
+    cmd+="$CONTAINER "
+
+    # exec can't set a cpuset, so pin the build inside the container
+    if [[ -n "$CPUSET_CPUS" ]]; then
+        cmd+="taskset -c $CPUSET_CPUS "
+    fi
+else
+    # --init so signals reach the build and the container exits when cancelled
+    run="$DOCKER run --rm --init "
+    run+="-h $(hostname) "
+    run+="--network none "
+    run+="-v $SRC:/linux:ro "
+    run+="$(get_alternate_binds) "
+    run+="-v $output_dir:/output:rw "
+
+    if [[ -n "$CPUSET_CPUS" ]]; then
+        run+="--cpuset-cpus=$CPUSET_CPUS "
+    fi
+
+    if [[ -n "$CPUSET_MEMS" ]]; then
+        run+="--cpuset-mems=$CPUSET_MEMS "
+    fi
 
-if [[ -z "$version" ]]; then
-    # NB, after we passed $version to get_output_dir()
-    version=$(get_default_version $distro)
-fi
+    if [[ -n $JOBSERVER ]]; then
+        run+="-v $JOBSERVER:/jobserver "
+    fi
+
+    if [[ -n "$CCACHE" ]]; then
+        run+="-v $CCACHE:/ccache "
+    fi
+
+    if [[ -n "$DOCKER_EXTRA_ARGS" ]]; then
+        # Can be used for eg. a rootdisk.
+        # DOCKER_EXTRA_ARGS="-v /path/to/rootdisk:/path/to/rootdisk:ro"
+        run+="$DOCKER_EXTRA_ARGS "
+    fi
 
-image="linuxppc/build:$distro-$version"
+    run+="$PODMAN_OPTS "
+
+    if [[ -z "$version" ]]; then
+        # NB, after we passed $version to get_output_dir()
+        version=$(get_default_version $distro)
+    fi
+
+    image="linuxppc/build:$distro-$version"
+
+    cmd="$run$cmd"
+    cmd+="$image "
+fi
 
-cmd+="$image "
 cmd+="/bin/container-build.sh $task"
 
 echo "## output        = $output_dir"
 
-(set -x; $cmd)
+# Stop the build running in the long lived container when we're cancelled,
+# otherwise it'd carry on until the container is removed.
+stop_build() {
+    echo "## Cancelled, stopping build in $CONTAINER"
+    $DOCKER exec "$CONTAINER" sh -c 'for f in /proc/[0-9]*/environ; do
+        if grep -qxz "BUILD_TAG=$1" "$f" 2> /dev/null; then
+            pid=${f#/proc/}
+            kill -TERM "${pid%/environ}"
+        fi
+    done' sh "$build_tag"
+    wait
+    exit 143
+}
+
+if [[ -n "$CONTAINER" && ! -t 0 ]]; then
+    # In the background, as bash only runs the trap once wait returns
+    trap stop_build TERM INT
+    (set -x; $cmd) &
+    wait $!
+else
+    (set -x; $cmd)
+fi
 
 ret=$?
 if [[ $ret -eq 0  && -n "$output_symlink" ]]; then
@@ -2,6 +2,44 @@
 
 JFACTOR=${JFACTOR:-1}
 
+# Mark the start of a phase of the build, with a timestamp, so ngci can
+# report how long each phase took. The "end" phase just ends the last one.
+phase() {
+    echo "## PHASE $1 ${EPOCHREALTIME:-$(date +%s)}"
+}
+
+# Write the installed modules in $1 to a single tarball, compressed as per
+# MODULES_FORMAT, using a parallel compressor where the image has one.
+modules_tarball() {
+    local format=${MODULES_FORMAT:-gz}
+    local threads=${JFACTOR:-1}
+    local compressor
+
+    case "$format" in
+        gz)  compressor="pigz -p $threads" ;;
+        bz2) compressor="pbzip2 -p$threads" ;;
+        xz)  compressor="xz -T $threads" ;;
+        zst) compressor="zstd -q -T$threads" ;;
+        *)
+            echo "!! Unknown MODULES_FORMAT $format"
+            return 1
+            ;;
+    esac
+
+    if ! command -v ${compressor%% *} > /dev/null; then
+        # Older images, fall back to the serial compressor
+        case "$format" in
+            gz)  compressor="gzip" ;;
+            bz2) compressor="bzip2" ;;
+        esac
+    fi
+
+    echo "## MODULES_FORMAT = $format ($compressor)"
+
+    rm -f $KBUILD_OUTPUT/modules.tar.*
+    (set -o pipefail; tar -cf - -C $1 lib | $compressor -c > $KBUILD_OUTPUT/modules.tar.$format)
+}
+
 gcc_version=$(${CROSS_COMPILE}gcc --version | head -1)
 ld_version=$(${CROSS_COMPILE}ld --version | head -1)
 
@@ -18,6 +56,23 @@ fi
 echo "## ld            = $ld_version"
 echo "## JFACTOR       = $JFACTOR"
 
+jobs="-j $JFACTOR"
+if [[ -n "$JOBSERVER" ]]; then
+    echo "## JOBSERVER     = $JOBSERVER"
+
+    # Take job slots from a jobserver shared with other builds, rather than
+    # our own -j. The jobserver is a fifo, open it and hand the fd to make.
+    # Make < 4.2 only understands --jobserver-fds.
+    exec 9<>"$JOBSERVER"
+    make_version=$(make --version | head -1 | awk '{print $3}')
+    if [[ $(printf '%s\n' 4.2 "$make_version" | sort -V | head -1) == "4.2" ]]; then
+        export MAKEFLAGS="-j --jobserver-auth=9,9"
+    else
+        export MAKEFLAGS="-j --jobserver-fds=9,9"
+    fi
+    jobs=""
+fi
+
 if [[ -n "$KBUILD_BUILD_TIMESTAMP" ]]; then
     echo "## KBUILD_TS     = $KBUILD_BUILD_TIMESTAMP"
 fi
@@ -26,7 +81,8 @@ if [[ -n "$KBUILD_EXTRA_WARN" ]]; then
     echo "## EXTRA_WARN    = $KBUILD_EXTRA_WARN"
 fi
 
-export KBUILD_OUTPUT=/output
+# Builds exec'ed into a long lived container are told where their output is
+export KBUILD_OUTPUT=${OUTPUT_DIR:-/output}
 
 if [[ -n "$QUIET" ]]; then
     quiet="-s"
@@ -46,6 +102,11 @@ if [[ "$1" == "kernel" ]]; then
 
     if [[ "$CCACHE" -eq 1 ]]; then
         cc="ccache $cc"
+
+        # Log the result of each compilation, so this build's hit rate can be
+        # worked out even though the cache is shared with other builds.
+        export CCACHE_STATSLOG=$KBUILD_OUTPUT/ccache-stats.log
+        rm -f $CCACHE_STATSLOG
     fi
 
     cc="CC=$cc"
@@ -55,12 +116,14 @@ if [[ "$1" == "kernel" ]]; then
     fi
 
     if [[ -n "$PRE_CLEAN" ]]; then
+        phase pre-clean
         (set -x; make $verbose $quiet $llvm "$cc" clean)
     fi
 
+    phase defconfig
     if [[ "$DEFCONFIG" == .config* || "$DEFCONFIG" == *.config ]]; then
         echo "## Using existing config $DEFCONFIG"
-        cp -f "$DEFCONFIG" /output/.config || exit 1
+        cp -f "$DEFCONFIG" $KBUILD_OUTPUT/.config || exit 1
     else
         # Strip off any suffix after the first '+' used for unique naming
         DEFCONFIG="${DEFCONFIG%%+*}"
@@ -75,14 +138,17 @@ if [[ "$1" == "kernel" ]]; then
         IFS=',' read -r -a configs <<< "$MERGE_CONFIG"
 
         # merge_config.sh always writes its TMP files to $PWD, so we have to
-        # change into /output before running it.
-        (cd /output; set -x; /linux/scripts/kconfig/merge_config.sh -m .config ${configs[@]})
+        # change into the output directory before running it.
+        phase merge-config
+        (cd $KBUILD_OUTPUT; set -x; /linux/scripts/kconfig/merge_config.sh -m .config ${configs[@]})
+        phase olddefconfig
         (set -x; make $verbose $quiet $llvm "$cc" olddefconfig)
     fi
 
     rc=$?
 
     if [[ -n "$MOD2YES" ]]; then
+        phase mod2yesconfig
         (set -x; make $verbose $quiet $llvm "$cc" mod2yesconfig)
     fi
 
@@ -92,43 +158,46 @@ if [[ "$1" == "kernel" ]]; then
             -e CONFIG_IKCONFIG=y \
             -e CONFIG_LOCALVERSION_AUTO=y \
             -e CONFIG_IKHEADERS=y \
-            /output/.config
+            $KBUILD_OUTPUT/.config
         if [[ $? -eq 0 ]]; then
             echo "!! Reproducible build specified, but the above options may prevent reproducibility."
         fi
     fi
 
     if [[ $rc -eq 0 ]]; then
+        phase compile
         if [[ -n "$SPARSE" ]]; then
-            rm -f /output/sparse.log
-            touch /output/sparse.log
-            (set -x; make C=$SPARSE CF=">> /output/sparse.log 2>&1" $verbose $quiet $llvm "$cc" -j $JFACTOR)
+            rm -f $KBUILD_OUTPUT/sparse.log
+            touch $KBUILD_OUTPUT/sparse.log
+            (set -x; make C=$SPARSE CF=">> $KBUILD_OUTPUT/sparse.log 2>&1" $verbose $quiet $llvm "$cc" $jobs)
 
             rc=$?
 
             if [[ $rc -eq 0 && -x arch/powerpc/tools/check-sparse-log.sh ]]; then
-                arch/powerpc/tools/check-sparse-log.sh /output/sparse.log
+                arch/powerpc/tools/check-sparse-log.sh $KBUILD_OUTPUT/sparse.log
                 rc=$?
             fi
         else
-            (set -x; make $verbose $quiet $llvm "$cc" -j $JFACTOR)
+            (set -x; make $verbose $quiet $llvm "$cc" $jobs)
             rc=$?
         fi
     fi
 
     if [[ $rc -eq 0 && -n "$MODULES" ]]; then
-        if grep CONFIG_MODULES=y /output/.config > /dev/null; then
+        if grep CONFIG_MODULES=y $KBUILD_OUTPUT/.config > /dev/null; then
             echo "## Installing modules"
 
-            mod_path=/output/modules
+            mod_path=$KBUILD_OUTPUT/modules
             # Clean out any old modules
             rm -rf $mod_path
 
-            (set -x; make $verbose $quiet -j $JFACTOR $llvm "$cc" INSTALL_MOD_PATH=$mod_path modules_install)
+            phase modules-install
+            (set -x; make $verbose $quiet $jobs $llvm "$cc" INSTALL_MOD_PATH=$mod_path modules_install)
             rc=$?
             if [[ $rc -eq 0 ]]; then
-                tar -cjf /output/modules.tar.bz2 -C $mod_path lib
-                tar -czf /output/modules.tar.gz -C $mod_path lib
+                phase modules-tar
+                modules_tarball $mod_path
+                rc=$?
             fi
         else
             echo "## Modules not configured"
@@ -137,10 +206,12 @@ if [[ "$1" == "kernel" ]]; then
 
     echo "## Kernel build completed rc = $rc"
 
-    /linux/scripts/clang-tools/gen_compile_commands.py -o /output/compile_commands.json /output > /dev/null 2>&1 || true
+    phase compile-commands
+    /linux/scripts/clang-tools/gen_compile_commands.py -o $KBUILD_OUTPUT/compile_commands.json $KBUILD_OUTPUT > /dev/null 2>&1 || true
+    phase end
 
-    if [[ -f /output/vmlinux ]]; then
-        size /output/vmlinux
+    if [[ -f $KBUILD_OUTPUT/vmlinux ]]; then
+        size $KBUILD_OUTPUT/vmlinux
     fi
 
     if [[ "$CCACHE" -eq 1 ]]; then
@@ -148,21 +219,23 @@ if [[ "$1" == "kernel" ]]; then
     fi
 
     if [[ -n "$POST_CLEAN" ]]; then
+        phase post-clean
         (set -x; make $verbose $quiet $llvm "$cc" clean)
+        phase end
     fi
 elif [[ "$1" == "docs" ]]; then
-    (set -x -o pipefail; make $verbose $quiet -j $JFACTOR htmldocs 2>&1 | tee /output/docs.log)
+    (set -x -o pipefail; make $verbose $quiet $jobs htmldocs 2>&1 | tee $KBUILD_OUTPUT/docs.log)
     rc=$?
 
     if [[ $rc -eq 0 ]]; then
-        grep -i "\bpowerpc\b.*warning" /output/docs.log
+        grep -i "\bpowerpc\b.*warning" $KBUILD_OUTPUT/docs.log
         if [[ $? -eq 0 ]]; then
             echo "## Error, saw powerpc errors/warnings in docs build!"
             rc=1
         fi
     fi
 elif [[ "$1" == "perf" ]]; then
-    cmd="make $quiet -C tools/perf O=/output"
+    cmd="make $quiet -C tools/perf O=$KBUILD_OUTPUT"
 
     if [[ $(uname -m) != "ppc64le" || $CROSS_COMPILE == "powerpc64-linux-gnu-" ]]; then
         cmd+=" NO_LIBELF=1 NO_LIBTRACEEVENT=1"
@@ -183,7 +256,7 @@ else
     # Workaround 303e6218ecec ("selftests: Fix O= and KBUILD_OUTPUT handling for relative paths")
     export abs_objtree=$KBUILD_OUTPUT
 
-    cmd="make -k $quiet $verbose -j $JFACTOR -C tools/testing/selftests"
+    cmd="make -k $quiet $verbose $jobs -C tools/testing/selftests"
 
     if [[ "$1" == "ppctests" ]]; then
         TARGETS="powerpc"
@@ -196,7 +269,7 @@ else
 
     if [[ -n "$INSTALL" ]]; then
        echo "## INSTALL       = $INSTALL"
-       cmd+=" INSTALL_PATH=/output/install install"
+       cmd+=" INSTALL_PATH=$KBUILD_OUTPUT/install install"
     fi
 
     which dpkg-query > /dev/null 2>&1
@@ -209,11 +282,14 @@ else
         (set -x; $cmd clean)
     fi
 
-    (set -x; make $quiet -j $JFACTOR headers)
+    phase headers
+    (set -x; make $quiet $jobs headers)
+    phase compile
     (set -x; $cmd)
     rc=$?
+    phase end
     echo "## Selftest build completed rc = $rc"
-    bins=$(find /output ! -path "/output/install/*" -type f -perm -u+x | wc -l)
+    bins=$(find $KBUILD_OUTPUT ! -path "$KBUILD_OUTPUT/install/*" -type f -perm -u+x | wc -l)
     echo "## Found $bins binaries"
 
     if [[ -n "$POST_CLEAN" ]]; then
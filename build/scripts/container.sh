@@ -0,0 +1,78 @@
+#!/bin/bash
+
+# Start or stop a long lived build container, which build.sh then runs builds
+# in with exec when CONTAINER is set, rather than starting a new container for
+# every build. The container is per image, the sub arch is ignored.
+
+if [[ -z "$1" ]]; then
+    echo "Usage: $0 <target>" >&2
+    exit 1
+fi
+
+if [[ -z "$CONTAINER" ]]; then
+    echo "Error: set CONTAINER to the container name" >&2
+    exit 1
+fi
+
+dir="$(dirname "$0")"
+script_base="$(realpath "$dir")"
+. "$script_base/lib.sh"
+
+IFS=@ read -r task subarch distro version <<< "$1"
+
+if [[ "$task" == "stop-container" ]]; then
+    (set -x; $DOCKER rm -f "$CONTAINER") > /dev/null
+    exit $?
+fi
+
+if [[ -z "$SRC" ]]; then
+    echo "Error: set SRC to your source tree" >&2
+    echo "       eg. make SRC=~/linux ..." >&2
+    exit 1
+fi
+
+SRC="${SRC/#\~/$HOME}"
+SRC=$(realpath "$SRC")
+
+if [[ -n "$CI_OUTPUT" ]]; then
+    output_dir="$CI_OUTPUT"
+else
+    output_dir="$script_base/../output"
+fi
+mkdir -p "$output_dir" || exit 1
+output_dir=$(realpath "$output_dir")
+
+if [[ -z "$version" ]]; then
+    version=$(get_default_version $distro)
+fi
+
+image="linuxppc/build:$distro-$version"
+
+cmd="$DOCKER run -d --rm --init "
+cmd+="--name $CONTAINER "
+cmd+="-h $(hostname) "
+cmd+="--network none "
+cmd+="-v $SRC:/linux:ro "
+cmd+="$(get_alternate_binds) "
+
+# Mounted at the same path, builds are told their output directory by exec
+cmd+="-v $output_dir:$output_dir:rw "
+cmd+="-u $(stat -c "%u:%g" $output_dir) "
+
+if [[ -n $JOBSERVER ]]; then
+    cmd+="-v $JOBSERVER:/jobserver "
+fi
+
+if [[ -n "$CCACHE" ]]; then
+    cmd+="-v $CCACHE:/ccache "
+fi
+
+if [[ -n "$DOCKER_EXTRA_ARGS" ]]; then
+    cmd+="$DOCKER_EXTRA_ARGS "
+fi
+
+cmd+="$PODMAN_OPTS "
+cmd+="$image "
+cmd+="sleep infinity"
+
+(set -x; $cmd) > /dev/null
@@ -41,7 +41,6 @@ function get_output_dir()
 
     case "$task" in
         kernel) ;&
-        prune-kernel) ;&
         clean-kernel)
 	    if [[ -n "$symlink" ]]; then
 		echo "$d/latest-kernel"
@@ -54,7 +53,6 @@ function get_output_dir()
             ;;
         ppctests) ;&
         selftests) ;&
-        prune-selftests) ;&
         clean-selftests)
 	    if [[ -n "$symlink" ]]; then
 		echo "$d/latest-selftests"
@@ -443,6 +443,30 @@ def qemu_selftests(args):
     return suite
 
 
+# The same kernel built and booted with each modules tarball format. Compare
+# the modules-tar phase of the builds and the qemu:modules phase of the boots,
+# and the totals, in report.json or trace.json.
+def modules_format_benchmark(args):
+    suite = TestSuite('modules-format-benchmark', qemus=args.qemus)
+    k = suite.add_kernel
+    b = suite.add_qemu_boot
+
+    if kvm_present():
+        accel = 'kvm'
+    else:
+        accel = 'tcg'
+
+    image = std_images(args)[0]
+
+    for fmt in ['gz', 'bz2', 'xz', 'zst']:
+        defconfig = f'ppc64le_guest_defconfig+modules-{fmt}'
+        k(defconfig, image, merge_config=guest_configs, modules_format=fmt)
+        # The Fedora userspace can decompress all the formats
+        b(f'qemu-pseries+p9+{accel}+fedora39', defconfig, image)
+
+    return suite
+
+
 def std_boot(args, hostname, defconfig, merge_configs, suite=None):
     images = args.images
     if not images:
@@ -0,0 +1,109 @@
+import logging
+import os
+from datetime import datetime, timedelta
+
+
+GB = 1024 * 1024 * 1024
+
+
+# Decides whether the host has room to start another job, going by the
+# footprint each job declares (job.mem in bytes, job.cpus) and by what the
+# host reports: MemAvailable, the load average and pressure stall info.
+#
+# The declared footprints catch a burst of jobs starting before they've
+# allocated anything, the host numbers catch jobs using more than declared.
+class AdmissionControl:
+    def __init__(self, mem_reserve, cpu_overcommit=1.5, max_pressure=20, patience=300):
+        self.mem_reserve = mem_reserve       # bytes always left free
+        self.cpus = os.cpu_count() * cpu_overcommit
+        self.max_pressure = max_pressure     # % of time stalled, over 10s
+        self.patience = timedelta(seconds=patience)
+        self.starved = None
+
+    def admit(self, job, running):
+        # A job that's been held back a long time gets the next free
+        # resources, rather than smaller jobs continually jumping ahead.
+        if self.starved and self.starved is not job:
+            return False
+
+        # Always admit a job when nothing's running, otherwise a job bigger
+        # than the host would never start.
+        reason = None
+        if len(running):
+            reason = self.check(job, running)
+
+        if reason is None:
+            if job.held_since:
+                logging.info(f'Starting {job.name} after {datetime.now() - job.held_since}')
+            self.starved = None
+            return True
+
+        if job.held_since is None:
+            job.held_since = datetime.now()
+            logging.info(f'Delaying {job.name}, {reason}')
+        else:
+            logging.debug(f'Still delaying {job.name}, {reason}')
+            if self.starved is None and datetime.now() - job.held_since > self.patience:
+                self.starved = job
+
+        return False
+
+    def check(self, job, running):
+        mem_total, mem_available = read_meminfo()
+        committed = sum(j.mem for j in running)
+        if committed + job.mem > mem_total - self.mem_reserve:
+            return f'{fmt_gb(committed)} of memory committed to running jobs, it needs {fmt_gb(job.mem)}'
+
+        if job.mem > mem_available - self.mem_reserve:
+            return f'{fmt_gb(mem_available)} of memory available, it needs {fmt_gb(job.mem)}'
+
+        pressure = read_pressure('memory')
+        if pressure is not None and pressure > self.max_pressure:
+            return f'memory pressure is {pressure}%'
+
+        committed = sum(j.cpus for j in running)
+        if committed + job.cpus > self.cpus:
+            return f'{committed} CPUs committed to running jobs, it needs {job.cpus}'
+
+        load = os.getloadavg()[0]
+        if load + job.cpus > self.cpus:
+            return f'load average is {load:.1f}, it needs {job.cpus} CPUs'
+
+        pressure = read_pressure('cpu')
+        if pressure is not None and pressure > self.max_pressure:
+            return f'CPU pressure is {pressure}%'
+
+        return None
+
+
+def read_meminfo():
+    info = {}
+    for line in open('/proc/meminfo'):
+        key, val = line.split(':', 1)
+        # Values are in kB
+        info[key] = int(val.split()[0]) * 1024
+
+    return info['MemTotal'], info.get('MemAvailable', info['MemFree'])
+
+
+# The "some" avg10 figure, ie. the % of the last 10s that at least one task
+# was stalled on the resource. None if PSI isn't available.
+def read_pressure(resource):
+    try:
+        lines = open(f'/proc/pressure/{resource}').readlines()
+    except OSError:
+        return None
+
+    for line in lines:
+        fields = line.split()
+        if fields[0] == 'some':
+            for field in fields[1:]:
+                key, val = field.split('=')
+                if key == 'avg10':
+                    return float(val)
+
+    return None
+
+
+def fmt_gb(val):
+    return f'{val / GB:.1f}G'
@@ -0,0 +1,89 @@
+import os
+import re
+
+
+# Hands out disjoint sets of CPUs to running jobs, keeping each set within
+# one NUMA node where possible, so concurrent builds and boots don't compete
+# for the same CPUs.
+class AffinityPlanner:
+    def __init__(self):
+        self.cpus = os.sched_getaffinity(0)
+        self.nodes = read_nodes(self.cpus)
+        self.free = set(self.cpus)
+
+    def allocate(self, count):
+        count = min(count, len(self.cpus))
+
+        # The node with the fewest free CPUs that still fits, so big jobs can
+        # still find a whole node later.
+        fits = [(len(self.free & cpus), node) for node, cpus in self.nodes.items()
+                if len(self.free & cpus) >= count]
+        if fits:
+            node = min(fits)[1]
+            cpus = sorted(self.free & self.nodes[node])[:count]
+        elif len(self.free) >= count:
+            # Span nodes, taking from the emptiest first
+            cpus = []
+            for node in sorted(self.nodes, key=lambda n: len(self.free & self.nodes[n]), reverse=True):
+                cpus += sorted(self.free & self.nodes[node])[:count - len(cpus)]
+        else:
+            return None
+
+        self.free -= set(cpus)
+        return cpus
+
+    def release(self, cpus):
+        self.free |= set(cpus)
+
+    def nodes_of(self, cpus):
+        return sorted(node for node, node_cpus in self.nodes.items() if node_cpus & set(cpus))
+
+
+def read_nodes(allowed):
+    nodes = {}
+    base = '/sys/devices/system/node'
+    try:
+        names = os.listdir(base)
+    except OSError:
+        names = []
+
+    for name in names:
+        m = re.fullmatch(r'node(\d+)', name)
+        if not m:
+            continue
+
+        cpus = parse_cpu_list(open(f'{base}/{name}/cpulist').read()) & allowed
+        if cpus:
+            nodes[int(m.group(1))] = cpus
+
+    if not nodes:
+        # No NUMA info, treat it as one node
+        nodes[0] = set(allowed)
+
+    return nodes
+
+
+def parse_cpu_list(val):
+    cpus = set()
+    for part in val.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+
+    return cpus
+
+
+# The inverse of parse_cpu_list(), eg. [0, 1, 2, 5] -> '0-2,5'
+def format_cpu_list(cpus):
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+
+    return ','.join(str(a) if a == b else f'{a}-{b}' for a, b in ranges)
@@ -1,4 +1,4 @@
-from utils import check_env_vars, filter_log_warnings, setup_logging
+from utils import check_env_vars, filter_log_warnings, setup_logging, tarball_suffix
 from datetime import datetime, timedelta
 from pexpect_utils import PexpectHelper
 from subprocess import run
@@ -381,10 +381,12 @@ class BasicBoot:
 
         if args.modules_path and self.install_modules:
             logging.info("Copying modules ...")
-            run(['scp', args.modules_path, f'{self.host_ssh_target}:/var/tmp/ngci-modules.tar.bz2'], check=True, timeout=minutes(5))
+            # Keep the suffix, so tar can tell how it's compressed
+            remote_path = f'/var/tmp/ngci-modules{tarball_suffix(args.modules_path)}'
+            run(['scp', args.modules_path, f'{self.host_ssh_target}:{remote_path}'], check=True, timeout=minutes(5))
             cmds.extend([
                 'cd /lib/modules',
-                'tar --strip-components=2 -xf /var/tmp/ngci-modules.tar.bz2',
+                f'tar --strip-components=2 -xf {remote_path}',
                 'sync',
                ]
             )
@@ -0,0 +1,114 @@
+import logging
+import os
+import shutil
+from hashlib import sha256
+
+
+# A cache of pruned kernel build outputs, keyed by a hash of everything that
+# went into the build. Each entry is a directory named by the key holding the
+# artifacts. Entries are evicted least recently used first once the cache
+# grows beyond max_size bytes.
+class BuildCache:
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, key):
+        return f'{self.path}/{key}'
+
+    def restore(self, key, dest):
+        src = self.entry_path(key)
+        if not os.path.isdir(src):
+            return False
+
+        try:
+            if os.path.exists(dest):
+                shutil.rmtree(dest)
+            os.makedirs(dest)
+            for name in os.listdir(src):
+                link_or_copy(f'{src}/{name}', f'{dest}/{name}')
+            # Mark as recently used
+            os.utime(src)
+        except OSError as e:
+            # Probably evicted underneath us by another build, just rebuild
+            logging.warning(f'Failed restoring {key} from build cache: {e}')
+            shutil.rmtree(dest, ignore_errors=True)
+            return False
+
+        return True
+
+    def store(self, key, src, exclude=[]):
+        dest = self.entry_path(key)
+        if os.path.isdir(dest):
+            return
+
+        # Populate a temporary directory then rename it into place, so other
+        # builds never see a partial entry.
+        tmp = f'{dest}.tmp-{os.getpid()}'
+        try:
+            os.makedirs(tmp)
+            for name in os.listdir(src):
+                path = f'{src}/{name}'
+                if os.path.isfile(path) and name not in exclude:
+                    link_or_copy(path, f'{tmp}/{name}')
+            os.rename(tmp, dest)
+        except OSError as e:
+            logging.warning(f'Failed storing {key} in build cache: {e}')
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            path = self.entry_path(name)
+            if '.tmp-' in name or not os.path.isdir(path):
+                continue
+
+            size = dir_size(path)
+            entries.append((os.path.getmtime(path), size, path))
+            total += size
+
+        entries.sort()
+        while total > self.max_size and len(entries) > 1:
+            _, size, path = entries.pop(0)
+            logging.debug(f'Evicting {path} from build cache')
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def link_or_copy(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def dir_size(path):
+    total = 0
+    for name in os.listdir(path):
+        try:
+            total += os.path.getsize(f'{path}/{name}')
+        except OSError:
+            pass
+    return total
+
+
+# Only the contents are hashed, not the paths, so the same inputs in a
+# different checkout give the same key.
+def hash_files(h, paths):
+    for path in paths:
+        h.update(open(path, 'rb').read())
+        h.update(b'\0')
+
+
+def cache_key(inputs, paths):
+    h = sha256()
+    for val in inputs:
+        h.update(str(val).encode('utf-8'))
+        h.update(b'\0')
+    hash_files(h, paths)
+    return h.hexdigest()
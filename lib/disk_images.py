@@ -0,0 +1,151 @@
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+from hashlib import sha256
+from utils import tarball_decompressor
+
+
+# Converts the modules/selftests tarballs into filesystem images the guest
+# can just mount, rather than decompressing and extracting them itself, which
+# is slow under TCG. Images are cached by a hash of the tarball, so a
+# tarball that's booted repeatedly is only converted once.
+
+DISK_IMAGE_FORMATS = {
+    'ext4': 'mkfs.ext4',
+    'squashfs': 'mksquashfs',
+    'erofs': 'mkfs.erofs',
+}
+
+IMAGE_CACHE_ENTRIES = 16
+
+def image_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME', '~/.cache')
+    return os.path.expanduser(f'{base}/ci-scripts/disk-images')
+
+
+# Returns the path to an image of the tarball's contents, with strip leading
+# path components removed, or None if it can't be created.
+def disk_image(tarball, fmt, strip):
+    tool = DISK_IMAGE_FORMATS.get(fmt)
+    if tool is None:
+        logging.error(f'Unknown disk image format {fmt}')
+        return None
+
+    if shutil.which(tool) is None:
+        logging.warning(f"Can't create {fmt} images, {tool} not found")
+        return None
+
+    # ext4 images need fakeroot to make the files owned by root, see make_image()
+    if fmt == 'ext4' and os.geteuid() != 0 and shutil.which('fakeroot') is None:
+        logging.warning(f"Can't create {fmt} images, fakeroot not found")
+        return None
+
+    h = sha256()
+    with open(tarball, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    h.update(f'{fmt} {strip}'.encode('utf-8'))
+
+    cache_dir = image_cache_dir()
+    path = f'{cache_dir}/{h.hexdigest()}.{fmt}'
+    if os.path.exists(path):
+        logging.info(f'Using cached {fmt} image of {tarball}')
+        # Mark as recently used
+        os.utime(path)
+        return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    start = time.time()
+    tmp = f'{path}.tmp-{os.getpid()}'
+    with tempfile.TemporaryDirectory(dir=cache_dir) as root:
+        try:
+            extract_tarball(tarball, strip, root)
+            make_image(fmt, root, tmp)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning(f'Failed creating {fmt} image of {tarball}: {e}')
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            return None
+
+    os.rename(tmp, path)
+    logging.info(f'Created {fmt} image of {tarball} in {time.time() - start:.1f}s')
+    prune_images(cache_dir)
+
+    return path
+
+
+# Checks both the decompressor and tar succeeded, so a truncated tarball
+# doesn't make a truncated image.
+def extract_tarball(tarball, strip, root):
+    decompress = shlex.split(tarball_decompressor(tarball))
+    with open(tarball, 'rb') as f:
+        p1 = subprocess.Popen(decompress, stdin=f, stdout=subprocess.PIPE)
+    tar = ['tar', f'--strip-components={strip}', '--no-same-owner', '-xf', '-', '-C', root]
+    p2 = subprocess.Popen(tar, stdin=p1.stdout)
+    p1.stdout.close()
+
+    for p in [p2, p1]:
+        p.wait()
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, p.args)
+
+
+def make_image(fmt, root, path):
+    if fmt == 'ext4':
+        # No journal, it's only ever mounted read only
+        size = tree_size(root)
+        size = size + size // 4 + 16 * 1024 * 1024
+        nfiles = sum(len(dirs) + len(files) for _, dirs, files in os.walk(root))
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        cmd = ['mkfs.ext4', '-q', '-F', '-O', '^has_journal', '-N', str(nfiles + 1024),
+               '-d', root, path]
+        # mkfs.ext4 copies the owners from the tree, unlike the other tools
+        # there's no option to make everything owned by root
+        if os.geteuid() == 0:
+            chown_tree(root)
+        else:
+            cmd = ['fakeroot', 'sh', '-c', 'chown -hR 0:0 "$1" && shift && exec "$@"', 'sh', root] + cmd
+    elif fmt == 'squashfs':
+        cmd = ['mksquashfs', root, path, '-noappend', '-quiet', '-all-root']
+    else:
+        cmd = ['mkfs.erofs', '--all-root', path, root]
+
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+
+
+def chown_tree(root):
+    os.lchown(root, 0, 0)
+    for dirpath, dirs, files in os.walk(root):
+        for name in files + dirs:
+            os.lchown(f'{dirpath}/{name}', 0, 0)
+
+
+# Allowing for each file rounding up to a whole block
+def tree_size(root):
+    total = 0
+    for dirpath, dirs, files in os.walk(root):
+        for name in files + dirs:
+            try:
+                size = os.lstat(f'{dirpath}/{name}').st_size
+            except OSError:
+                continue
+            total += (size + 4095) // 4096 * 4096
+
+    return total
+
+
+def prune_images(cache_dir):
+    images = [f'{cache_dir}/{name}' for name in os.listdir(cache_dir) if '.tmp-' not in name]
+    images = [path for path in images if os.path.isfile(path)]
+    images.sort(key=os.path.getmtime, reverse=True)
+    for old in images[IMAGE_CACHE_ENTRIES:]:
+        logging.debug(f'Removing old disk image {old}')
+        try:
+            os.unlink(old)
+        except FileNotFoundError:
+            pass
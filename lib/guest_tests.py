@@ -0,0 +1,256 @@
+import logging
+import os
+from functools import partial
+from qemu import QemuConfig, GuestPool, kvm_or_tcg
+from utils import test_harness
+from pexpect_utils import xmon_enter, xmon_exit
+from dump import read_symbols, find_symbol
+
+
+########################################
+# Tests that run on a booted qemu guest.
+#
+# Each test sets up the guest it wants and returns the callback to run once
+# it's booted. Tests that ask for the same guest share one boot, so the tests
+# are written to leave the guest as they found it, unless they're marked as
+# tainting it.
+########################################
+
+class GuestTest:
+    def __init__(self, setup, cpus, machines, taints=False):
+        self.setup = setup
+        self.cpus = cpus
+        self.machines = machines
+        self.taints = taints
+
+
+# The guest xmon and cpu_hotplug share, cpu_hotplug needs exactly 2 CPUs
+def setup_smp_guest(qconf):
+    qconf.smp = 2
+    qconf.host_mounts = []
+
+    if os.environ.get('QEMU_QUIET', None) is None:
+        qconf.quiet = True
+
+
+# The guest ptdump and lkdtm share, ptdump's expected output is for 2G
+def setup_small_guest(qconf):
+    qconf.mem = '2G'
+    qconf.smp = 1
+
+
+def setup_xmon(qconf):
+    setup_smp_guest(qconf)
+    cpu = qconf.cpu.upper()
+
+    def test_xmon(qconf, p):
+        xmon_enter(p)
+
+        p.send('e')
+        p.expect_prompt()
+
+        p.send('r')
+        p.expect_prompt()
+
+        p.send('t')
+        p.expect_prompt()
+
+        p.send('dp')
+        p.expect_prompt()
+
+        if cpu == 'POWER8':
+            p.send('dv c008000000000000')
+            p.expect_prompt()
+        else:
+            p.send('dv c000000000000000')
+            p.expect('Maps physical address = 0x0000000000000000')
+            p.expect_prompt()
+
+            p.send('dv c000000040000000')
+            p.expect('Maps physical address = 0x0000000040000000')
+            p.expect_prompt()
+
+            p.send('dv c00dffffffff0000')
+            p.expect('No valid P4D')
+            p.expect_prompt()
+
+        xmon_exit(p)
+
+    return test_xmon
+
+
+# Test that CPU hotplug minimally works and doesn't pop any warnings in dmesg
+def setup_cpu_hotplug(qconf):
+    setup_smp_guest(qconf)
+    return test_cpuhotplug
+
+
+def test_cpuhotplug(qconf, p):
+    # Check we have 2 CPUs online
+    p.send('grep -H . /sys/devices/system/cpu/cpu*/online')
+    p.expect('/sys/devices/system/cpu/cpu0/online:1')
+    p.expect('/sys/devices/system/cpu/cpu1/online:1')
+    p.expect_prompt()
+
+    for n in [0, 1]:
+        # Offline a cpu
+        p.cmd(f'echo 0 > /sys/devices/system/cpu/cpu{n}/online')
+
+        # Check it's offline
+        p.send(f'grep -H . /sys/devices/system/cpu/cpu{n}/online')
+        p.expect(f'/sys/devices/system/cpu/cpu{n}/online:0')
+        p.expect_prompt()
+
+        # Bring it back online
+        p.cmd(f'echo 1 > /sys/devices/system/cpu/cpu{n}/online')
+
+        # Check it's online again
+        p.send(f'grep -H . /sys/devices/system/cpu/cpu{n}/online')
+        p.expect(f'/sys/devices/system/cpu/cpu{n}/online:1')
+        p.expect_prompt()
+
+    # Offline cpu 0
+    p.cmd(f'echo 0 > /sys/devices/system/cpu/cpu0/online')
+
+    # Offline cpu 1 (should fail)
+    p.send(f'echo 0 > /sys/devices/system/cpu/cpu1/online')
+    p.expect('Device or resource busy')
+    p.expect_prompt()
+
+    # Leave the guest as we found it, for the next test
+    p.cmd(f'echo 1 > /sys/devices/system/cpu/cpu0/online')
+
+
+# Test that ptdump works
+def setup_ptdump(qconf):
+    setup_small_guest(qconf)
+    cpu = qconf.cpu.upper()
+
+    syms = read_symbols(qconf.vmlinux)
+
+    start = find_symbol(syms, '__start')
+
+    boundary = find_symbol(syms, '__srwx_boundary')
+    if boundary is None:
+        boundary = find_symbol(syms, '__init_begin')
+
+    if start is None or boundary is None:
+        logging.error("Can't determine SRWX boundary?")
+        return False
+
+    def test_ptdump(qconf, p):
+        p.cmd('mount -t debugfs none /sys/kernel/debug')
+        p.send('cat /sys/kernel/debug/kernel_page_tables')
+        i = p.expect(["can't open '/sys/kernel/debug/kernel_page_tables': No such file or directory",
+                    "Start of kernel VM"])
+
+        if i == 0:
+            logging.error("Kernel not built with CONFIG_PTDUMP_DEBUGFS?")
+            return False
+
+        if cpu == 'POWER9':
+            p.expect("---[ Start of kernel VM ]---")
+            p.expect("0xc000000000000000-0xc000000001ffffff  0x0000000000000000        32M         r      X   pte  valid  present        dirty  accessed")
+            p.expect("0xc000000002000000-0xc00000007fffffff  0x0000000002000000      2016M         r  w       pte  valid  present        dirty  accessed")
+            p.expect("---[ vmalloc() Area ]---")
+            # vmalloc/IO mappings change so skip those
+            p.expect("---[ vmemmap start ]---")
+            p.expect("0xc00c000000000000-0xc00c0000001fffff  0x000000006e000000         2M         r  w       pte  valid  present        dirty  accessed")
+        elif cpu == 'POWER8':
+            p.cmd('cat /sys/kernel/debug/kernel_hash_pagetable | head')
+
+        p.expect_prompt()
+        p.cmd('umount /sys/kernel/debug')
+
+    return test_ptdump
+
+
+LKDTM_TRIGGERS = ['BUG', 'WARNING', 'WARNING_MESSAGE', 'EXCEPTION', 'ARRAY_BOUNDS',
+         'CORRUPT_LIST_ADD', 'CORRUPT_LIST_DEL', 'REPORT_STACK_CANARY',
+         'UNALIGNED_LOAD_STORE_WRITE', 'SLAB_LINEAR_OVERFLOW', 'VMALLOC_LINEAR_OVERFLOW',
+         'READ_AFTER_FREE', 'READ_BUDDY_AFTER_FREE', 'SLAB_INIT_ON_ALLOC',
+         'BUDDY_INIT_ON_ALLOC', 'SLAB_FREE_DOUBLE', 'SLAB_FREE_CROSS', 'SLAB_FREE_PAGE',
+         'EXEC_DATA', 'EXEC_STACK', 'EXEC_KMALLOC', 'EXEC_VMALLOC', 'EXEC_RODATA',
+         'EXEC_USERSPACE', 'EXEC_NULL', 'ACCESS_USERSPACE', 'ACCESS_NULL', 'WRITE_RO',
+         'WRITE_RO_AFTER_INIT', 'WRITE_KERN', 'WRITE_OPD', 'REFCOUNT_INC_OVERFLOW',
+         'REFCOUNT_ADD_OVERFLOW', 'REFCOUNT_INC_NOT_ZERO_OVERFLOW',
+         'REFCOUNT_ADD_NOT_ZERO_OVERFLOW', 'REFCOUNT_DEC_ZERO', 'REFCOUNT_DEC_NEGATIVE',
+         'REFCOUNT_DEC_AND_TEST_NEGATIVE', 'REFCOUNT_SUB_AND_TEST_NEGATIVE',
+         'REFCOUNT_INC_ZERO', 'REFCOUNT_ADD_ZERO', 'REFCOUNT_INC_SATURATED',
+         'REFCOUNT_DEC_SATURATED', 'REFCOUNT_ADD_SATURATED',
+         'REFCOUNT_INC_NOT_ZERO_SATURATED', 'REFCOUNT_ADD_NOT_ZERO_SATURATED',
+         'REFCOUNT_DEC_AND_TEST_SATURATED', 'REFCOUNT_SUB_AND_TEST_SATURATED',
+         'USERCOPY_SLAB_SIZE_TO', 'USERCOPY_SLAB_SIZE_FROM', 'USERCOPY_SLAB_WHITELIST_TO',
+         'USERCOPY_SLAB_WHITELIST_FROM', 'USERCOPY_STACK_FRAME_TO',
+         'USERCOPY_STACK_FRAME_FROM', 'USERCOPY_STACK_BEYOND', 'USERCOPY_KERNEL',
+         'FORTIFY_STRSCPY', 'FORTIFY_STR_OBJECT', 'FORTIFY_STR_MEMBER',
+         'FORTIFY_MEM_OBJECT', 'FORTIFY_MEM_MEMBER',
+]
+
+# Provokes crashes, so the guest is rebooted afterward
+def setup_lkdtm(qconf):
+    setup_small_guest(qconf)
+
+    def test_lkdtm(qconf, p):
+        p.cmd('mount -t debugfs none /sys/kernel/debug')
+
+        for trigger in LKDTM_TRIGGERS:
+            p.send(f"sh -c 'echo {trigger} > /sys/kernel/debug/provoke-crash/DIRECT'")
+            p.expect(p.prompt, bug_patterns=[])
+
+    return test_lkdtm
+
+
+# The machines and CPUs each test runs on by default. The CPUs are spelt the
+# way each test always has, as that's passed to qemu and decides whether it
+# can use KVM, see kvm_possible().
+GUEST_TESTS = {
+    'xmon':        GuestTest(setup_xmon, ['POWER8', 'POWER9', 'POWER10'], ['pseries', 'powernv']),
+    'cpu_hotplug': GuestTest(setup_cpu_hotplug, ['POWER8', 'POWER10'], ['pseries', 'powernv']),
+    'ptdump':      GuestTest(setup_ptdump, ['power8', 'power9'], ['pseries']),
+    'lkdtm':       GuestTest(setup_lkdtm, ['power8', 'power9', 'power10'], ['pseries'], taints=True),
+}
+
+
+def run_guest_test(pool, test, name, cpu, machine):
+    qconf = QemuConfig(machine)
+    qconf.configure_from_env()
+    qconf.cpu = cpu
+    qconf.accel = kvm_or_tcg(machine, cpu)
+
+    callback = test.setup(qconf)
+    if callback is False:
+        return False
+
+    qconf.apply_defaults()
+
+    if qconf.unsupported:
+        logging.info(f'Skipping, {qconf.unsupported}')
+        return None
+
+    return pool.run(qconf, callback, taints=test.taints)
+
+
+# Run the named tests, on the given machines and CPUs, or each test's own if
+# not given. The runs are grouped by guest, with tests that taint it last, so
+# each guest is booted once for all the tests that can share it.
+def run_guest_tests(names, machines=None, cpus=None):
+    runs = []
+    for name in names:
+        test = GUEST_TESTS[name]
+        for machine in machines or test.machines:
+            for cpu in cpus or test.cpus:
+                runs.append((machine, cpu, name))
+
+    guests = list(dict.fromkeys((machine, cpu) for machine, cpu, name in runs))
+    runs.sort(key=lambda run: (guests.index(run[:2]), GUEST_TESTS[run[2]].taints))
+
+    pool = GuestPool()
+    rc = True
+    for machine, cpu, name in runs:
+        func = partial(run_guest_test, pool, GUEST_TESTS[name])
+        rc &= test_harness(func, name, cpu=cpu, machine=machine)
+
+    rc &= pool.finish()
+
+    return rc
@@ -1,21 +1,31 @@
 #!/usr/bin/python3
 
 import argparse
+import asyncio
+import contextvars
+import json
 import sys
 import logging
 import os
 import os.path
 import re
+import shutil
+import signal
+import tempfile
 import time
 from copy import copy
 from collections import OrderedDict
-from datetime import datetime
+from datetime import datetime, timedelta
 from hashlib import sha1
-from multiprocessing import Process, Pipe
-from subprocess import check_output, call, run, DEVNULL, Popen, PIPE
+from subprocess import check_output, call, run, CalledProcessError, CompletedProcess, DEVNULL, Popen, PIPE
 
 import defaults
-from qemu import kvm_present
+from admission import AdmissionControl, GB
+from affinity import AffinityPlanner, format_cpu_list
+from build_cache import BuildCache, cache_key
+from qemu import kvm_present, qemu_unsupported, powernv_machine
+from report import JobResult, count_warnings, write_json_report, write_junit_report
+from timeline import parse_phase_markers, write_trace
 
 try:
     from termcolor import colored
@@ -43,6 +53,18 @@ def get_git_rev(path):
         return None
 
 
+# The tree id of HEAD, or None if there are uncommitted changes, because then
+# the tree id doesn't describe the source.
+def get_git_tree(path):
+    result = run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=path, capture_output=True)
+    if result.returncode != 0 or len(result.stdout):
+        return None
+
+    cmd = 'git rev-parse HEAD^{tree}'
+    result = run(cmd.split(), cwd=path, capture_output=True, check=True)
+    return result.stdout.decode('utf-8').strip()
+
+
 def mkdirp(path):
     logging.debug('mkdir %s', path)
     os.makedirs(path, exist_ok=True)
@@ -58,6 +80,8 @@ class State:
             output = os.getcwd()
 
         suite_name = suite_name.replace('/', '_').replace(' ', '_')
+        self.output = output
+        self.suite_name = suite_name
         self.output_dir = f'{output}/{suite_name}'
         self.dry_run = args.dry_run
         self.skip_boot = args.skip_boot
@@ -67,10 +91,57 @@ class State:
         self.kfactor = args.kfactor    # number of parallel builds
         self.jfactor = args.jfactor    # parallelism of each build
         self.bfactor = args.bfactor    # number of parallel boots
+        self.jobserver = args.jobserver # size of shared make jobserver
+        self.jobserver_path = None
+        self.jobserver_fd = None
+        self.jobserver_tokens = 0
         self.kfilter = args.kfilter    # kernels to build
         self.sfilter = args.sfilter    # selftests to build
         self.bfilter = args.bfilter    # hosts to boot
         self.tfilter = args.tfilter    # tests to run
+        self.job_stats = OrderedDict() # per-stage scheduler stats
+
+        self.durations_path = args.durations
+        if self.durations_path is None:
+            self.durations_path = f'{self.output_dir}/durations.json'
+        self.durations = load_durations(self.durations_path)
+        self.durations_shared = args.durations is not None
+
+        self.shard = args.shard        # (i, N) or None
+        self.shard_items = set()       # kernels & selftests in our shard
+
+        self.build_cache = None
+        if args.build_cache:
+            self.build_cache = BuildCache(args.build_cache, args.build_cache_size * 1024 * 1024 * 1024)
+        self.src_tree = None
+
+        self.ccache = args.ccache
+        self.ccache_size = args.ccache_size
+        if self.ccache:
+            self.ccache = os.path.realpath(self.ccache)
+
+        self.workers = args.workers    # hosts to build kernels on
+        self.worker_queue = None       # free worker slots
+
+        self.admission = None
+        if args.admission_control:
+            self.admission = AdmissionControl(args.mem_reserve * GB)
+
+        self.affinity = None
+        if args.pin_cpus:
+            self.affinity = AffinityPlanner()
+
+        self.persistent_containers = args.persistent_containers
+        self.containers = {}           # image -> long lived build container
+
+        self.changed_since = args.changed_since
+        self.changed_files = None      # files changed since changed_since
+        self.unaffected = set()        # builds not affected by those changes
+        self.merge_configs = {}        # see kernel_configs()
+
+        self.resume = args.resume
+        self.journal_path = f'{self.output_dir}/journal.jsonl'
+        self.journal = {}
 
 
 def defconfig_subarch(defconfig):
@@ -104,7 +175,7 @@ def defconfig_subarch(defconfig):
 
 class KernelBuild:
     def __init__(self, defconfig, image, merge_config=[], clang=False,
-                 sparse=False, modules=True, llvm_ias=False):
+                 sparse=False, modules=True, llvm_ias=False, modules_format='gz'):
         self.defconfig = defconfig
         self.image = image
         self.merge_config = merge_config
@@ -112,6 +183,7 @@ class KernelBuild:
         self.llvm_ias = llvm_ias
         self.sparse = sparse
         self.modules = modules
+        self.modules_format = modules_format # gz, bz2, xz or zst
 
         subarch = defconfig_subarch(defconfig)
         self.subarch = subarch
@@ -122,6 +194,49 @@ class KernelBuild:
         defconfig_dir = self.defconfig.replace('/', '_')
         return f'{defconfig_dir}@{self.subarch}@{self.image}'
 
+    # Rough build time in seconds, used to order builds that haven't run before
+    def cost_estimate(self):
+        base_config = self.defconfig.split('+')[0]
+        if base_config.endswith('allyesconfig') or base_config.endswith('allmodconfig'):
+            cost = 1800
+        else:
+            cost = 300
+
+        if self.clang:
+            cost *= 1.5
+        if self.sparse:
+            cost *= 2
+
+        return cost
+
+    # Rough peak memory and CPUs used, for admission control
+    def footprint(self, state):
+        base_config = self.defconfig.split('+')[0]
+        if base_config.endswith('allyesconfig') or base_config.endswith('allmodconfig'):
+            mem = 8 * GB
+        else:
+            mem = 2 * GB
+
+        # With a jobserver CPUs are shared out by make
+        if state.jobserver:
+            return (mem, 1)
+
+        return (mem, state.jfactor)
+
+    # The constructor arguments, so a worker can recreate the build with
+    # KernelBuild(**d), see build_on_worker()
+    def to_dict(self):
+        return {
+            'defconfig': self.defconfig,
+            'image': self.image,
+            'merge_config': self.merge_config,
+            'clang': self.clang,
+            'sparse': self.sparse,
+            'modules': self.modules,
+            'llvm_ias': self.llvm_ias,
+            'modules_format': self.modules_format,
+        }
+
     def __eq__(self, other):
         # name covers defconfig and image
         return (self.name == other.name and
@@ -130,7 +245,8 @@ class KernelBuild:
                 self.clang == other.clang and
                 self.llvm_ias == other.llvm_ias and
                 self.sparse == other.sparse and
-                self.modules == other.modules)
+                self.modules == other.modules and
+                self.modules_format == other.modules_format)
 
     def __str__(self):
         l = [self.name]
@@ -144,7 +260,9 @@ class KernelBuild:
             l.append('sparse')
         if self.modules:
             l.append('modules')
-            
+            if self.modules_format != 'gz':
+                l.append(f'modules_format={self.modules_format}')
+
         return '/'.join(l)
 
 
@@ -163,6 +281,16 @@ class SelftestsBuild:
         self.name = f'{target_dir}@{self.full_image}'
         self.output_dir = self.name
 
+    def cost_estimate(self):
+        if self.target == 'ppctests':
+            return 180
+        return 600
+
+    def footprint(self, state):
+        if state.jobserver:
+            return (2 * GB, 1)
+        return (2 * GB, state.jfactor)
+
 
 class BootConfig:
     def __init__(self, name, defconfig, image, script=None, tests=[], cmdline=None):
@@ -203,10 +331,25 @@ class BootConfig:
     def long_description(self):
         return f'{self.name} with {self.defconfig} using {self.script}'
 
+    def cost_estimate(self):
+        # Real hardware, mostly waiting for firmware and reboots
+        return 900 + 600 * len(self.tests)
+
+    def footprint(self, state):
+        # Just a console and ssh sessions
+        return (GB // 4, 1)
+
+    # Why the boot can't be done, or None
+    def unsupported(self, state):
+        return None
+
+
+# The CPUs the qemu boot scripts are named for, eg. qemu-pseries+p9+tcg
+QEMU_SCRIPT_CPUS = {'p8': 'POWER8', 'p9': 'POWER9', 'p10': 'POWER10'}
 
 class QemuBootConfig(BootConfig):
     def __init__(self, name, defconfig, image, script=None, tests=[],
-                 qemu=None, cmdline=None):
+                 qemu=None, cmdline=None, machine=None, cpu=None):
         super().__init__(name, defconfig, image, script, tests, cmdline)
         if qemu in ['default', None]:
             qemu = defaults.QEMU_VERSION
@@ -214,6 +357,18 @@ class QemuBootConfig(BootConfig):
         self.callbacks = []
         self.args = []
 
+        # The machine and CPU qemu is asked for, going by the script's name if
+        # not given. Only known for the pseries/powernv scripts, and the CPU
+        # isn't checked under KVM, where the host decides.
+        words = self.script.split('+')
+        if machine is None and words[0] in ['qemu-pseries', 'qemu-powernv']:
+            machine = words[0][len('qemu-'):]
+            if 'kvm' not in words:
+                cpus = [QEMU_SCRIPT_CPUS[w] for w in words if w in QEMU_SCRIPT_CPUS]
+                cpu = cpus[0] if cpus else None
+        self.machine = machine
+        self.cpu = cpu
+
     def __eq__(self, other):
         return (super().__eq__(other) and
                 self.qemu_version == other.qemu_version)
@@ -225,6 +380,38 @@ class QemuBootConfig(BootConfig):
     def long_description(self):
         return f'{self.name} with {self.defconfig} using {self.script} using qemu {self.qemu_version}'
 
+    def cost_estimate(self):
+        if re.search(r'\bkvm\b', self.script):
+            cost = 120
+        else:
+            cost = 300
+
+        for test in self.tests:
+            if isinstance(test, QemuSelftestsConfig):
+                cost += 1200
+            else:
+                cost += 60
+
+        return cost
+
+    # Matches the defaults in QemuConfig.apply_defaults(), plus some
+    # overhead for qemu itself.
+    def footprint(self, state):
+        if 'pseries' in self.script or 'powernv' in self.script:
+            mem = 4 * GB
+        else:
+            mem = GB
+        mem += GB // 2
+
+        if 'mac99' in self.script:
+            cpus = 1
+        elif re.search(r'\bkvm\b', self.script):
+            cpus = 8
+        else:
+            cpus = 2
+
+        return (mem, cpus)
+
     def dir_name(self):
         if self.qemu_version in ['mainline', 'host']:
             # Use it directly
@@ -243,20 +430,45 @@ class QemuBootConfig(BootConfig):
         args = copy(self.args)
         args.extend([f'--callback "{c}"' for c in self.callbacks])
 
-        ver = self.qemu_version
+        path = self.qemu_path(state)
+        if path:
+            args.append(f'--qemu-path {path}')
+
+        return args
+
+    def qemu_path(self, state):
         if self.qemu_version == 'host':
             # No qemu path needed, default to path lookup
-            return args
+            return None
 
         if self.qemu_version.startswith('/'):
             # Treat it as a full path to the bin directory
-            path = self.qemu_version
-        else:
-            # Version number pointing to directory under external/qemu/
-            path = f'{state.script_dir}/external/qemu/qemu-{ver}/install/bin'
+            return self.qemu_version
 
-        args.append(f'--qemu-path {path}')
-        return args
+        # Version number pointing to directory under external/qemu/
+        return f'{state.script_dir}/external/qemu/qemu-{self.qemu_version}/install/bin'
+
+    # Check the machine and CPU against what the qemu binary supports, from
+    # the cached capabilities, so impossible boots are skipped without
+    # starting anything. Boots of unknown machines are assumed to be fine.
+    def unsupported(self, state):
+        if self.machine is None:
+            return None
+
+        machine = self.machine
+        if machine == 'powernv':
+            machine = powernv_machine(self.cpu)
+
+        emulator = 'qemu-system-ppc64'
+        path = self.qemu_path(state)
+        if path:
+            emulator = f'{path}/{emulator}'
+
+        try:
+            return qemu_unsupported(emulator, machine, self.cpu)
+        except Exception as e:
+            logging.debug(f'Probing {emulator} failed: {e}')
+            return None
 
 
 class TestConfig:
@@ -417,6 +629,8 @@ def ngci_get_parser():
                         help='Kernel build parallelism')
     parser.add_argument('-k', dest='kfactor', type=int, default=int(os.environ.get('KFACTOR', 1)),
                         help='Number of concurrent kernel builds')
+    parser.add_argument('-J', dest='jobserver', type=int, default=int(os.environ.get('JOBSERVER_SLOTS', 0)),
+                        help='Share a make jobserver of this many slots between all builds (overrides -j)')
     parser.add_argument('-b', dest='bfactor', type=int, default=int(os.environ.get('BFACTOR', 1)),
                         help='Number of concurrent boots')
     parser.add_argument('-K', dest='kfilter', type=str, default=None, action='append', help='Filter kernel builds')
@@ -425,6 +639,32 @@ def ngci_get_parser():
     parser.add_argument('-T', dest='tfilter', type=str, default=None, action='append', help='Filter tests to run')
     parser.add_argument('-i', dest='images',  type=str, default=[],   action='append', help='Images')
     parser.add_argument('-q', dest='qemus',   type=str, default=[], action='append', help='Qemu versions to test with')
+    parser.add_argument('--durations', type=str, default=None,
+                        help='File of job durations from previous runs (default <output>/durations.json)')
+    parser.add_argument('--build-cache', type=str, default=os.environ.get('NGCI_BUILD_CACHE', None),
+                        help='Directory to cache kernel build artifacts in')
+    parser.add_argument('--build-cache-size', type=int, default=int(os.environ.get('NGCI_BUILD_CACHE_SIZE', 50)),
+                        help='Maximum size of the build cache in GB (default 50)')
+    parser.add_argument('--ccache', type=str, default=os.environ.get('NGCI_CCACHE', None),
+                        help='Directory for ccache, one cache per image is kept under it')
+    parser.add_argument('--ccache-size', type=int, default=int(os.environ.get('NGCI_CCACHE_SIZE', 10)),
+                        help='Maximum size of each image\'s ccache in GB (default 10)')
+    parser.add_argument('--worker', dest='workers', type=parse_worker, default=[], action='append',
+                        help='Build kernels on a worker, local[:slots] or ssh:host[:slots]. May be repeated')
+    parser.add_argument('--admission-control', action='store_true',
+                        help='Only start jobs when there is enough free memory and CPU for them')
+    parser.add_argument('--mem-reserve', type=int, default=int(os.environ.get('NGCI_MEM_RESERVE', 2)),
+                        help='Memory in GB to leave free when admitting jobs (default 2)')
+    parser.add_argument('--pin-cpus', action='store_true',
+                        help='Give each running build and boot its own CPUs, within a NUMA node where possible')
+    parser.add_argument('--persistent-containers', action='store_true',
+                        help='Run builds in one long lived container per image')
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help='Only run shard i of N of the suite, as i/N. Durations are only used if passed with --durations')
+    parser.add_argument('--changed-since', type=str, default=None,
+                        help='Only build and boot what could be affected by changes since this revision')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip jobs that completed OK in the previous run with the same inputs')
     parser.add_argument('--skip-boot', action='store_true', help='Skip booting, just run tests')
     parser.add_argument('-t', '--test-suite', dest='test_suite', type=str, required=True, help='Test suite to run')
     parser.add_argument('src', type=str, help='Path to source repository')
@@ -478,6 +718,8 @@ def ngci_args(args, test_suite):
     logging.info(f'jfactor: {state.jfactor} # kernel build parallelism')
     logging.info(f'kfactor: {state.kfactor} # number of concurrent kernel builds')
     logging.info(f'bfactor: {state.bfactor} # number of concurrent boots')
+    if state.jobserver:
+        logging.info(f'jobserver: {state.jobserver} # slots shared by all builds')
     if state.kfilter:
         logging.info(f'kfilter: {state.kfilter} # kernel build filter')
     if state.sfilter:
@@ -488,28 +730,158 @@ def ngci_args(args, test_suite):
         logging.info(f'tfilter: {state.tfilter} # test filter')
     if args.images:
         logging.info(f'images: {args.images}')
+    if state.build_cache or state.resume:
+        state.src_tree = get_git_tree(state.src)
+        if state.src_tree is None:
+            logging.warning(colored('Source tree has uncommitted changes, not using the build cache or resuming', 'yellow'))
+            state.build_cache = None
+            state.resume = False
+    if state.shard:
+        logging.info(f'shard: {state.shard[0]}/{state.shard[1]}')
+    if state.workers:
+        for kind, host, slots in state.workers:
+            logging.info(f'worker: {host or kind} # {slots} slots')
+    if state.admission:
+        logging.info(f'admission control: {state.admission.cpus:g} CPUs, {args.mem_reserve}GB memory reserve')
+    if state.affinity:
+        logging.info(f'pinning: {len(state.affinity.cpus)} CPUs in {len(state.affinity.nodes)} NUMA nodes')
+    if state.build_cache:
+        logging.info(f'build cache: {state.build_cache.path}')
+    if state.ccache:
+        logging.info(f'ccache: {state.ccache} # {state.ccache_size}GB per image')
+    if state.changed_since:
+        state.changed_files = get_changed_files(state.src, state.changed_since)
+        if state.changed_files is None:
+            logging.warning(colored(f"Couldn't diff against {state.changed_since}, building everything", 'yellow'))
+        else:
+            logging.info(f'changed since: {state.changed_since} # {len(state.changed_files)} files')
+    if state.resume:
+        state.journal = load_journal(state.journal_path)
+        logging.info(f'resuming: {len(state.journal)} jobs in journal')
+    elif not state.dry_run:
+        # Start a new journal
+        open(state.journal_path, 'w').close()
     logging.info('')
 
     if args.dry_run:
         banner("Dry run", colour='blue')
 
-    if run_one_config(test_suite, state):
+    result = run_one_config(test_suite, state)
+
+    if state.jobserver_fd is not None:
+        os.close(state.jobserver_fd)
+        os.unlink(state.jobserver_path)
+
+    if result:
         return 0
 
     return -1
 
 
+# Create a GNU make jobserver fifo that every build takes job slots from, so
+# all cores stay busy even when only one build is left running.
+def start_jobserver(state, builds):
+    path = f'{state.output_dir}/jobserver'
+    if os.path.exists(path):
+        os.unlink(path)
+    os.mkfifo(path, 0o600)
+
+    # Each make gets one implicit slot without taking a token, so only hand
+    # out the remainder, for as many builds as can run at once. Holding the
+    # fifo open means it never sees EOF.
+    local = len([job for job in builds if job.pool == 'build'])
+    concurrent = min(state.kfactor, local) if state.kfactor else local
+    state.jobserver_tokens = max(state.jobserver - concurrent, 0)
+
+    # Non-blocking, so it can be drained, see reset_jobserver()
+    state.jobserver_fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+    os.write(state.jobserver_fd, b'+' * state.jobserver_tokens)
+    state.jobserver_path = path
+
+
+# A make that's killed never gives back the tokens it took, so once no build
+# is running, and so none should be held, put the pool back to full.
+def reset_jobserver(state):
+    try:
+        while os.read(state.jobserver_fd, 4096):
+            pass
+    except BlockingIOError:
+        pass
+    os.write(state.jobserver_fd, b'+' * state.jobserver_tokens)
+
+
 def run_one_config(test_suite, state):
     start = datetime.now()
 
-    build_result = build(test_suite, state)
-    if build_result:
-        banner("OK", colour='green')
-    elif test_suite.continue_on_error:
-        banner("Failed - continuing", char='!', colour='red')
+    if state.shard:
+        shard_suite(test_suite, state)
+
+    builds = build_jobs(test_suite, state)
+    boots = boot_jobs(test_suite, state, builds)
 
-    if build_result or test_suite.continue_on_error:
-        boot_result = boot_kernels(test_suite, state)
+    if state.jobserver:
+        start_jobserver(state, builds.values())
+
+    if len(boots):
+        banner('Building kernels & selftests, booting kernels ...')
+        mkdirp(f'{state.boot_dir}')
+    else:
+        banner('Building kernels & selftests ...')
+
+    # Builds and boots share one scheduler, so a boot starts as soon as the
+    # kernel (and any selftests) it needs have been built.
+    jobs = list(builds.values()) + boots
+    factors = {
+        'build': state.kfactor,
+        'boot': state.bfactor,
+        'worker': sum(slots for _, _, slots in state.workers),
+    }
+    def on_complete(job):
+        if state.jobserver_fd is not None and job.pool == 'build':
+            if not any(j.pool == 'build' and j.start and not j.end for j in jobs):
+                reset_jobserver(state)
+
+        if state.dry_run:
+            return
+
+        journal_append(state, job)
+        if job.result:
+            record_duration(state, job)
+
+    # Work done outside of jobs, for the trace
+    extra_spans = []
+
+    if state.persistent_containers and not state.dry_run:
+        containers_start = datetime.now()
+        start_containers(state, builds.values())
+        extra_spans.append(('containers', 'start containers', containers_start, datetime.now()))
+
+    admit = None
+    if state.admission:
+        admit = state.admission.admit
+
+    async def run_all():
+        if state.workers:
+            # Queues belong to the event loop, so it's created here
+            state.worker_queue = asyncio.Queue()
+            for kind, host, slots in state.workers:
+                for i in range(slots):
+                    state.worker_queue.put_nowait((kind, host, i))
+
+        return await run_jobs(jobs, factors, test_suite.continue_on_error, state.job_stats,
+                              on_complete, admit, state.affinity)
+
+    try:
+        asyncio.run(run_all())
+    finally:
+        if state.containers:
+            containers_start = datetime.now()
+            stop_containers(state, builds.values())
+            extra_spans.append(('containers', 'stop containers', containers_start, datetime.now()))
+        empty_trash(state)
+
+    build_result = all(job.result for job in builds.values())
+    boot_result = all(job.result for job in boots)
 
     if not build_result or not boot_result:
         banner("Failed", char='!', colour='red')
@@ -517,11 +889,81 @@ def run_one_config(test_suite, state):
         banner("OK", colour='green')
 
     end = datetime.now()
+    if not state.dry_run:
+        write_reports(state, jobs, start, end, extra_spans)
+    log_job_stats(state)
+    log_ccache_stats(state, builds.values())
     logging.info(f'Completed {test_suite.name} in {end - start}')
 
     return build_result
 
 
+def container_base_cmd(state):
+    cmd = ['make', '--no-print-directory', '-C', f'{state.script_dir}/build']
+    cmd.append(f'SRC={state.src}')
+    cmd.append(f'CI_OUTPUT={state.build_dir}')
+    cmd.append(f'DOCKER_EXTRA_ARGS=-v {state.config_dir}:/configs:ro')
+
+    if state.jobserver_path:
+        cmd.append(f'JOBSERVER={state.jobserver_path}')
+
+    return cmd
+
+
+# Start one long lived container per image, which builds are then exec'ed
+# into, rather than paying for a container start-up on every build.
+def start_containers(state, builds):
+    mkdirp(state.build_dir)
+
+    for job in builds:
+        # Built on a worker, which doesn't use our containers
+        if job.pool != 'build':
+            continue
+
+        item = job.args[1]
+        if item.image in state.containers:
+            continue
+
+        name = f"ngci-{os.getpid()}-{item.image.replace('@', '-')}"
+        cmd = container_base_cmd(state)
+        cmd.append(f'CONTAINER={name}')
+        if state.ccache:
+            cmd.append(f'CCACHE={ccache_dir(state, item.image)}')
+        cmd.append(f'start-container@{item.subarch}@{item.image}')
+        logging.debug(cmd)
+
+        start = datetime.now()
+        result = run(cmd, stdout=PIPE, stderr=PIPE, stdin=DEVNULL)
+        startup = datetime.now() - start
+
+        if result.returncode != 0:
+            logging.warning(colored(f'Failed starting container for {item.image}, using a container per build', 'yellow'))
+            logging.debug(result.stderr.decode('utf-8'))
+            continue
+
+        logging.info(f'Started container {name} for {item.image} in {startup}')
+        state.containers[item.image] = {'name': name, 'startup': startup, 'subarch': item.subarch}
+
+
+def stop_containers(state, builds):
+    for image, container in state.containers.items():
+        # Only builds that ran to completion in it, failed or cancelled builds
+        # may not have got as far as the container.
+        served = len([job for job in builds if job.args[1].image == image
+                      and job.result and 'build' in job.result.phases])
+        saved = container['startup'] * max(served - 1, 0)
+        logging.info(f"Container {container['name']} served {served} builds, "
+                     f"saving ~{saved} of container start-up")
+
+        cmd = container_base_cmd(state)
+        cmd.append(f"CONTAINER={container['name']}")
+        cmd.append(f"stop-container@{container['subarch']}@{image}")
+        logging.debug(cmd)
+        run(cmd, stdout=DEVNULL, stderr=DEVNULL, stdin=DEVNULL)
+
+    state.containers = {}
+
+
 def filter_matches(name, filters):
     for f in filters:
         if f.startswith('!'):
@@ -537,39 +979,475 @@ def filter_matches(name, filters):
     return False
 
 
-def build(test_suite, state):
-    banner('Building kernels & selftests ...')
+def parse_shard(val):
+    m = re.fullmatch(r'(\d+)/(\d+)', val)
+    if not m:
+        raise argparse.ArgumentTypeError(f"shard must be of the form i/N, not '{val}'")
 
-    jobs = []
+    index, count = int(m.group(1)), int(m.group(2))
+    if index < 1 or index > count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 1 and {count}")
+
+    return (index, count)
+
+
+# Every runner has to come up with the same split, so only use durations from
+# previous runs if they were passed explicitly, presumably shared by all the
+# runners, otherwise use the static estimates.
+def shard_cost(state, name, item):
+    if state.durations_shared:
+        return job_cost(state, name, item)
+    return item.cost_estimate()
+
+
+# Split the suite into shards of roughly equal cost. Each kernel goes in a
+# shard along with all its boots, so the boots find the kernel's artifacts
+# locally. Kernels are placed longest first onto the least loaded shard.
+# Selftests are built in every shard that boots with them.
+def shard_suite(test_suite, state):
+    index, count = state.shard
+
+    units = OrderedDict()
     for k in test_suite.kernels.values():
+        units[k.name] = shard_cost(state, k.dir_name(), k)
+
+    used_selftests = set()
+    for boot in test_suite.boots.values():
+        name = boot.kernel_build.name
+        units[name] = units.get(name, 0) + shard_cost(state, boot.dir_name(), boot)
+        for test in boot.tests:
+            selftests = getattr(test, 'selftests', None)
+            if selftests:
+                used_selftests.add(selftests.name)
+
+    # Selftests that no boot uses are balanced like kernels
+    for s in test_suite.selftests.values():
+        if s.name not in used_selftests:
+            units[s.name] = shard_cost(state, s.output_dir, s)
+
+    # Sort by name too, so equal costs are split the same way everywhere
+    loads = [0] * count
+    for name, cost in sorted(units.items(), key=lambda u: (-u[1], u[0])):
+        shard = loads.index(min(loads))
+        loads[shard] += cost
+        if shard == index - 1:
+            state.shard_items.add(name)
+
+    nboots = 0
+    for boot in test_suite.boots.values():
+        if boot.kernel_build.name not in state.shard_items:
+            continue
+
+        nboots += 1
+        for test in boot.tests:
+            selftests = getattr(test, 'selftests', None)
+            if selftests:
+                state.shard_items.add(selftests.name)
+
+    nkernels = len([k for k in test_suite.kernels.values() if k.name in state.shard_items])
+    logging.info(f'Shard {index}/{count}: {nkernels} kernels, {nboots} boots, '
+                 f'estimated {timedelta(seconds=int(loads[index - 1]))}')
+
+
+def get_changed_files(src, rev):
+    # Against the working tree, so uncommitted changes count too
+    result = run(['git', '-C', src, 'diff', '--name-only', rev], stdout=PIPE, stderr=DEVNULL)
+    if result.returncode != 0:
+        return None
+
+    return result.stdout.decode('utf-8').splitlines()
+
+
+# Changes to these never affect a build
+UNBUILT_FILES = ['MAINTAINERS', 'CREDITS', 'README', 'COPYING', '.mailmap', '.gitignore']
+UNBUILT_PREFIXES = ('Documentation/', 'LICENSES/')
+
+
+# Work out whether a changed file could affect a kernel build, going by the
+# compile_commands.json from its previous build. When in doubt it's affected.
+#
+# Sources and local headers only affect the build if something in the same
+# directory was compiled, because files can be #included by their neighbours
+# (eg. kernel/sched/). Shared headers, Kconfig, Makefiles, scripts etc. always
+# affect it, unless they're under another architecture.
+def kernel_affected(state, kernel):
+    # A failed build's compile_commands.json only covers what was compiled
+    # before it failed, and vmlinux is removed by the clean before each build.
+    build_dir = f'{state.build_dir}/{kernel.dir_name()}'
+    if not os.path.exists(f'{build_dir}/vmlinux'):
+        return True
+
+    entry = state.journal.get(kernel.dir_name(), None)
+    if entry is not None and not entry['result']:
+        return True
+
+    path = f'{build_dir}/compile_commands.json'
+    try:
+        commands = json.load(open(path))
+    except (FileNotFoundError, ValueError):
+        # Never built, or built before compile_commands.json was kept
+        return True
+
+    dirs = set()
+    arches = set()
+    for entry in commands:
+        source = entry.get('file', '')
+        if not source.startswith('/linux/'):
+            continue
+
+        source = source[len('/linux/'):]
+        dirs.add(os.path.dirname(source))
+        if source.startswith('arch/'):
+            arches.add(source.split('/')[1])
+
+    for path in state.changed_files:
+        if path in UNBUILT_FILES or path.startswith(UNBUILT_PREFIXES):
+            continue
+
+        if path.startswith('tools/testing/'):
+            continue
+
+        if path.startswith('arch/') and path.split('/')[1] not in arches:
+            continue
+
+        name = os.path.basename(path)
+        if name.startswith(('Kconfig', 'Makefile', 'Kbuild')):
+            return True
+
+        if path.startswith(('include/', 'scripts/', 'tools/')) or '/include/' in path:
+            return True
+
+        if name.endswith(('.c', '.S', '.h')) and '/' in path:
+            if os.path.dirname(path) in dirs:
+                return True
+            continue
+
+        return True
+
+    return False
+
+
+def selftests_affected(state):
+    for path in state.changed_files:
+        if path in UNBUILT_FILES or path.startswith(UNBUILT_PREFIXES):
+            continue
+
+        # The selftests build uses the uapi headers, via make headers
+        if path.startswith(('tools/', 'scripts/', 'usr/')) or '/uapi/' in path or '/' not in path:
+            return True
+
+    return False
+
+
+def boot_affected(state, boot):
+    if boot.kernel_build.name not in state.unaffected:
+        return True
+
+    for test in boot.tests:
+        selftests = getattr(test, 'selftests', None)
+        if selftests and selftests.name not in state.unaffected:
+            return True
+
+    return False
+
+
+def build_jobs(test_suite, state):
+    jobs = OrderedDict()
+    for k in test_suite.kernels.values():
+        if state.shard and k.name not in state.shard_items:
+            logging.debug(f'Skipping kernel build {k.name}, not in our shard')
+            continue
+
         if state.kfilter and not filter_matches(k.name, state.kfilter):
             logging.debug(f'Skipping kernel build {k.name} due to filter')
             continue
-        jobs.append(Job(build_one_kernel, (state, k)))
+
+        if state.changed_files is not None and not kernel_affected(state, k):
+            logging.info(f'Skipping kernel build {k.name}, not affected by changes since {state.changed_since}')
+            state.unaffected.add(k.name)
+            continue
+
+        if state.workers:
+            func, pool = build_on_worker, 'worker'
+        else:
+            func, pool = build_one_kernel, 'build'
+
+        job = Job(k.dir_name(), func, (state, k), pool,
+                  cost=job_cost(state, k.dir_name(), k),
+                  input_hash=kernel_input_hash(state, k),
+                  cleanup=lambda k=k: remove_partial_output(f'{state.build_dir}/{k.dir_name()}'))
+        if resumable(state, job, f'{state.build_dir}/{k.dir_name()}/vmlinux'):
+            continue
+        if not state.workers:
+            job.mem, job.cpus = k.footprint(state)
+        # The jobserver already shares the CPUs out between builds
+        job.pin = not state.jobserver
+        jobs[k.name] = job
 
     for s in test_suite.selftests.values():
+        if state.shard and s.name not in state.shard_items:
+            logging.debug(f'Skipping selftest build {s.target}, not in our shard')
+            continue
+
         if state.sfilter and not filter_matches(s.target, state.sfilter):
             logging.debug(f'Skipping selftest build {s.target} due to filter')
             continue
-        jobs.append(Job(build_one_selftest, (state, s)))
 
-    result = run_jobs(jobs, state.kfactor, test_suite.continue_on_error)
+        if state.changed_files is not None and not selftests_affected(state):
+            logging.info(f'Skipping selftest build {s.name}, not affected by changes since {state.changed_since}')
+            state.unaffected.add(s.name)
+            continue
+
+        job = Job(s.output_dir, build_one_selftest, (state, s), 'build',
+                  cost=job_cost(state, s.output_dir, s),
+                  input_hash=selftests_input_hash(state, s),
+                  cleanup=lambda s=s: remove_partial_output(f'{state.build_dir}/{s.output_dir}'))
+        if resumable(state, job, f'{state.build_dir}/{s.output_dir}/selftests.tar.gz'):
+            continue
+        job.mem, job.cpus = s.footprint(state)
+        job.pin = not state.jobserver
+        jobs[s.name] = job
+
+    return jobs
+
+
+def parse_worker(val):
+    m = re.fullmatch(r'(local|ssh:([^:]+))(:(\d+))?', val)
+    if not m:
+        raise argparse.ArgumentTypeError(f"worker must be local[:slots] or ssh:host[:slots], not '{val}'")
+
+    kind = m.group(1).split(':')[0]
+    slots = int(m.group(4) or 1)
+    return (kind, m.group(2), slots)
+
+
+# Raised by a job when the slot it was running on has gone away, so the job
+# should be run again somewhere else, see run_jobs(). slots is how many slots
+# went with it, including the one the job was running in.
+class SlotLost(Exception):
+    def __init__(self, msg, slots=1):
+        super().__init__(msg)
+        self.slots = slots
+
+
+# A worker that's died in one slot is no use in the others, so take its idle
+# slots out of the queue. Slots in use are lost as their builds fail.
+def drop_worker_slots(state, kind, host):
+    keep = []
+    dropped = 0
+    while not state.worker_queue.empty():
+        slot = state.worker_queue.get_nowait()
+        if slot[:2] == (kind, host):
+            dropped += 1
+        else:
+            keep.append(slot)
+
+    for slot in keep:
+        state.worker_queue.put_nowait(slot)
+
+    return dropped
+
+
+# Build a kernel on a worker, either locally or over ssh, with the same paths
+# on the worker as here. Each build takes a free worker slot from the queue.
+#
+# The worker is sent the build as one line of JSON on stdin, runs
+# build_one_kernel() and replies on stdout with a line of JSON per message
+# logged, as they're logged, then one with the result. The pruned artifacts
+# are then copied back, along with the full log.
+async def build_on_worker(state, kernel, number, total):
+    slot = await state.worker_queue.get()
+    kind, host, _ = slot
+    name = host or kind
+
+    argv = ['-o', os.path.abspath(state.output), '-j', str(state.jfactor), '-t', state.suite_name]
+    if state.dry_run:
+        argv.append('--dry-run')
+    if state.ccache:
+        argv.extend(['--ccache', state.ccache, '--ccache-size', str(state.ccache_size)])
+    argv.append(os.path.abspath(state.src))
+
+    request = {
+        'argv': argv,
+        'suite': state.suite_name,
+        'head': get_git_head(state.src),
+        'kernel': kernel.to_dict(),
+        'number': number,
+        'total': total,
+    }
+
+    cmd = [f'{os.path.abspath(state.script_dir)}/scripts/ngci/ngci-worker']
+    if kind == 'ssh':
+        cmd = ['ssh', '-o', 'BatchMode=yes', host] + cmd
+    else:
+        cmd = [sys.executable] + cmd
+
+    logging.debug(f'Sending {kernel.name} to worker {name}')
+    proc = await spawn_async(cmd, stdin=PIPE, stdout=PIPE)
+    result = None
+    worker_pid = None
+    try:
+        proc.stdin.write((json.dumps(request) + '\n').encode('utf-8'))
+        await proc.stdin.drain()
+        proc.stdin.close()
+
+        async for line in proc.stdout:
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+
+            if 'log' in msg:
+                logging.log(msg['level'], f"[{name}] {msg['log']}")
+            elif 'pid' in msg:
+                worker_pid = msg['pid']
+            elif 'result' in msg:
+                result = JobResult.from_dict(msg['result'])
+    except OSError:
+        pass
+    except BaseException:
+        # Cancelled while it's still building. The worker cancels its build
+        # on SIGTERM, see ngci_worker_main(), so give it time to stop that.
+        #
+        # ssh doesn't pass signals on, so signal an ssh worker over another
+        # connection, otherwise its build would run on with no one listening.
+        if kind == 'ssh' and worker_pid:
+            kill = ['ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=10', host,
+                    'kill', '-TERM', str(worker_pid)]
+            logging.debug(kill)
+            await run_async(kill, stdin=DEVNULL, stdout=DEVNULL)
+        await stop_async(proc, 2 * CANCEL_TIMEOUT)
+        raise
+    await wait_async(proc)
+
+    if result is None:
+        # Don't hand the slot back, it's dead
+        dropped = drop_worker_slots(state, kind, host)
+        raise SlotLost(f'Worker {name} died building {kernel.name}', 1 + dropped)
+
+    if kind == 'ssh' and not state.dry_run:
+        start = time.time()
+        ci_output_dir = f'{state.build_dir}/{kernel.dir_name()}'
+        mkdirp(ci_output_dir)
+        if result:
+            cmd = ['rsync', '-a', '--delete', f'{host}:{ci_output_dir}/', f'{ci_output_dir}/']
+        else:
+            # Only the log, a failed build isn't pruned. Anything left from an
+            # earlier build here is stale, as it would be after a local build.
+            remove_partial_output(ci_output_dir)
+            cmd = ['rsync', '-a', f'{host}:{ci_output_dir}/log.txt', f'{ci_output_dir}/']
+
+        logging.debug(cmd)
+        if (await run_async(cmd, stdin=DEVNULL)).returncode != 0:
+            dropped = drop_worker_slots(state, kind, host)
+            raise SlotLost(f"Couldn't copy {kernel.name} back from worker {name}", 1 + dropped)
+        result.add_span('copy', start, time.time())
+
+    state.worker_queue.put_nowait(slot)
     return result
 
 
-def build_one_kernel(state, kernel, number, total):
-    logging.info(f'Building {number}/{total} {kernel.name} ...')
+# Containers are started by the container runtime, so don't inherit our CPU
+# affinity, instead tell build.sh to pin them to the same CPUs.
+def cpuset_args(state):
+    if not state.affinity:
+        return []
+
+    job = current_job.get(None)
+    if not job or not job.cpuset:
+        # Not pinned
+        return []
+
+    cpus = job.cpuset
+
+    nodes = state.affinity.nodes_of(cpus)
+    return [f'CPUSET_CPUS={format_cpu_list(cpus)}', f'CPUSET_MEMS={format_cpu_list(nodes)}']
+
+
+def get_git_head(path):
+    return check_output(['git', '-C', path, 'rev-parse', 'HEAD']).decode('utf-8').strip()
+
+
+def ngci_worker_main(orig_args):
+    # Replies go over stdout, so send anything else written there to stderr
+    replies = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+
+    def reply(msg):
+        replies.write(json.dumps(msg) + '\n')
+        replies.flush()
+
+    class ReplyHandler(logging.Handler):
+        def emit(self, record):
+            reply({'log': self.format(record), 'level': record.levelno})
+
+    handler = ReplyHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(logging.INFO)
+
+    # So ngci can signal us if it's cancelled, see build_on_worker()
+    reply({'pid': os.getpid()})
+
+    request = json.loads(sys.stdin.readline())
+    args = ngci_get_parser().parse_args(request['argv'])
+
+    arg0_dir = os.path.dirname(os.path.realpath(orig_args[0]))
+    state = State(f'{arg0_dir}/../..', request['suite'], args)
+    if state.build_cache:
+        state.src_tree = get_git_tree(state.src)
+        if state.src_tree is None:
+            state.build_cache = None
+
+    head = get_git_head(state.src)
+    if head != request['head']:
+        msg = f"Source tree is at {head} not {request['head']}"
+        logging.error(colored(msg, 'red'))
+        reply({'result': JobResult().fail(msg).to_dict()})
+        return 0
+
+    kernel = KernelBuild(**request['kernel'])
+
+    # We run in our own session, but the build runs in another, so cancel it
+    # on SIGTERM, which stops it the same way a cancelled local build is.
+    async def build():
+        task = asyncio.current_task()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+        return await build_one_kernel(state, kernel, request['number'], request['total'])
+
+    try:
+        result = asyncio.run(build())
+    except asyncio.CancelledError:
+        logging.warning(colored(f'Cancelled building {kernel.name}', 'yellow'))
+        return 1
+    reply({'result': result.to_dict()})
 
-    extra = f"-v {state.config_dir}:/configs:ro"
-    os.environ['DOCKER_EXTRA_ARGS'] = extra
+    return 0
+
+
+async def build_one_kernel(state, kernel, number, total):
+    logging.info(f'Building {number}/{total} {kernel.name} ...')
 
     base_cmd = ['make', '--no-print-directory', '-C', f'{state.script_dir}/build']
+    base_cmd.append(f'DOCKER_EXTRA_ARGS=-v {state.config_dir}:/configs:ro')
     base_cmd.append(f'SRC={state.src}')
     base_cmd.append(f'DEFCONFIG={kernel.defconfig}')
     base_cmd.append(f'CI_OUTPUT={state.build_dir}')
     base_cmd.append(f'JFACTOR={state.jfactor}')
     base_cmd.append('QUIET=1')
 
+    if state.jobserver_path:
+        base_cmd.append(f'JOBSERVER={state.jobserver_path}')
+
+    container = state.containers.get(kernel.image, None)
+    if container:
+        base_cmd.append(f"CONTAINER={container['name']}")
+
+    base_cmd.extend(cpuset_args(state))
+
+    if state.ccache and not state.dry_run:
+        base_cmd.append(f'CCACHE={ccache_dir(state, kernel.image)}')
+
     if kernel.clang:
         base_cmd.append('CLANG=1')
         if kernel.llvm_ias:
@@ -586,53 +1464,337 @@ def build_one_kernel(state, kernel, number, total):
 
     if kernel.modules:
         cmd.append('MODULES=1')
+        cmd.append(f'MODULES_FORMAT={kernel.modules_format}')
 
+    job_result = JobResult()
+
+    configs = []
     if kernel.merge_config:
-        configs = munge_configs(state, kernel.merge_config)
+        configs = kernel_configs(state, kernel)
         if configs is None:
-            return False
+            return job_result.fail('Invalid merge config')
         val = ','.join(configs)
         cmd.append(f'MERGE_CONFIG={val}')
 
+    ci_output_dir = f'{state.build_dir}/{kernel.dir_name()}'
+    log_path = f'{ci_output_dir}/log.txt'
+    job_result.log_path = log_path
+
+    if state.build_cache and not state.dry_run:
+        key = kernel_cache_key(state, kernel, configs)
+        # Restoring and storing walk the filesystem, so keep them off the
+        # event loop to not hold up other jobs.
+        with job_result.phase('restore'):
+            restored = await asyncio.to_thread(state.build_cache.restore, key, ci_output_dir)
+        if restored:
+            log = open(log_path, 'w')
+            print(f'Restored from build cache {key}', file=log)
+            log.close()
+            logging.info(f'{ok()} Restored {kernel.name} from build cache')
+            job_result.add_artifacts(ci_output_dir)
+            return job_result
+
     if not state.dry_run:
         # Clean so a failed build doesn't leave old artifacts lying around
         clean_cmd = copy(base_cmd)
         clean_cmd.append(f'clean-kernel@{full_image}')
         logging.debug(clean_cmd)
-        run(clean_cmd, stdin=DEVNULL, check=True)
+        with job_result.phase('clean'):
+            await run_async(clean_cmd, stdin=DEVNULL, check=True)
 
-    ci_output_dir = f'{state.build_dir}/{kernel.dir_name()}'
     mkdirp(ci_output_dir)
-    log_path = f'{ci_output_dir}/log.txt'
     log = open(log_path, 'w')
 
     logging.debug(cmd)
 
     if state.dry_run:
-        return True
+        return job_result
 
     start = datetime.now()
-    result = run(cmd, stdout=log, stderr=log, stdin=DEVNULL)
+    with job_result.phase('build'):
+        result = await run_async(cmd, stdout=log, stderr=log, stdin=DEVNULL)
     end = datetime.now()
+    job_result.exit_codes['build'] = result.returncode
+    add_build_phases(job_result, log_path, kernel.name)
 
     if result.returncode != 0:
         log.close()
+        job_result.warnings = count_warnings(log_path)
         logging.error(colored(f'Failed building {kernel.name}', 'red'))
         logging.info(f'See: {log_path}')
         dump_log(log_path)
-        return False
+        return job_result.fail(f'Build exited with {result.returncode}')
 
     logging.info(f'{ok()} Build of {kernel.name} took {end - start}')
 
-    cmd = copy(base_cmd)
-    cmd.append(f'prune-kernel@{full_image}')
-    logging.debug(cmd)
-    run(cmd, stdout=log, stderr=log, stdin=DEVNULL, check=True)
+    if state.ccache:
+        save_ccache_stats(ci_output_dir, end - start)
+
+    print(f'Pruning non-outputs in {ci_output_dir}', file=log)
     log.close()
+    job_result.warnings = count_warnings(log_path)
+    with job_result.phase('prune'):
+        prune_kernel(state, ci_output_dir)
+    job_result.add_artifacts(ci_output_dir)
+
+    if state.build_cache:
+        # The log is rewritten on restore, so don't share it with the cache
+        # ccache stats would be misleading for a restored build
+        with job_result.phase('store'):
+            await asyncio.to_thread(state.build_cache.store, key, ci_output_dir,
+                                    exclude=['log.txt', 'ccache.json'])
+
+    return job_result
+
+
+# Add the phases container-build.sh marked in the build log to the result,
+# and log how the build's time was split between them.
+def add_build_phases(job_result, log_path, name):
+    totals = OrderedDict()
+    for phase, start, end in parse_phase_markers(log_path):
+        job_result.add_span(phase, start, end)
+        totals[phase] = totals.get(phase, 0) + end - start
+
+    build_time = job_result.phases.get('build', 0)
+    if not totals or not build_time:
+        return
+
+    l = [f'{phase} {timedelta(seconds=round(secs))} ({100 * secs / build_time:.0f}%)'
+         for phase, secs in totals.items()]
+    logging.info(f"Phases of {name}: {', '.join(l)}")
+
+
+# Artifacts kept from a kernel build, and what they're renamed to
+KERNEL_ARTIFACTS = {
+    '.config': 'config',
+    'vmlinux': 'vmlinux',
+    'System.map': 'System.map',
+    'arch/powerpc/boot/zImage': 'zImage',
+    'include/config/kernel.release': 'kernel.release',
+    'arch/powerpc/kernel/asm-offsets.s': 'asm-offsets.s',
+    'arch/powerpc/boot/uImage': 'uImage',
+    'modules.tar.gz': 'modules.tar.gz',
+    'modules.tar.bz2': 'modules.tar.bz2',
+    'modules.tar.xz': 'modules.tar.xz',
+    'modules.tar.zst': 'modules.tar.zst',
+    'sparse.log': 'sparse.log',
+    'ccache.json': 'ccache.json',
+    'compile_commands.json': 'compile_commands.json',
+    'log.txt': 'log.txt',
+}
+
+
+# The modules tarball a build produced, whichever format it's in
+def modules_artifact(path):
+    for name in KERNEL_ARTIFACTS:
+        if name.startswith('modules.tar.') and os.path.exists(f'{path}/{name}'):
+            return f'{path}/{name}'
+
+    return None
+
+
+def prune_kernel(state, path):
+    if not os.path.exists(f'{path}/Makefile'):
+        # Assume it's already been pruned
+        return
+
+    prune_output(state, path, KERNEL_ARTIFACTS)
+
+
+async def prune_selftests(state, path, log):
+    if not os.path.exists(f'{path}/kselftest'):
+        # Assume it's already been pruned
+        return True
+
+    if os.path.isdir(f'{path}/install'):
+        os.rename(f'{path}/install', f'{path}/selftests')
+        cmd = ['tar', '-czf', 'selftests.tar.gz', 'selftests']
+        if (await run_async(cmd, cwd=path, stdout=log, stderr=log, stdin=DEVNULL)).returncode != 0:
+            return False
 
+    prune_output(state, path, {'selftests.tar.gz': 'selftests.tar.gz', 'log.txt': 'log.txt'})
     return True
 
 
+# Keep only the given artifacts in a build output directory. Everything else
+# is moved aside into the trash and deleted in the background, so the build
+# slot is freed straight away rather than after walking the object tree.
+def prune_output(state, path, keep):
+    trash_dir = f'{state.build_dir}/.trash'
+    mkdirp(trash_dir)
+
+    # Unique, as the same output can be pruned again while the last lot is
+    # still being deleted
+    trash = tempfile.mkdtemp(prefix=f'{os.path.basename(path)}-', dir=trash_dir)
+    os.rename(path, f'{trash}/output')
+    os.makedirs(path)
+
+    for src, dest in keep.items():
+        if os.path.exists(f'{trash}/output/{src}'):
+            os.rename(f'{trash}/output/{src}', f'{path}/{dest}')
+
+    # In its own session so it isn't caught up in cancelling the job
+    Popen(['rm', '-rf', trash], stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, start_new_session=True)
+
+
+# Finish off any deletions still running in the background, or left over from
+# an interrupted run.
+def empty_trash(state):
+    trash_dir = f'{state.build_dir}/.trash'
+    if not os.path.isdir(trash_dir):
+        return
+
+    start = datetime.now()
+    shutil.rmtree(trash_dir, ignore_errors=True)
+    logging.debug(f'Emptied {trash_dir} in {datetime.now() - start}')
+
+
+# One ccache per image, as objects built by different toolchains never match
+def ccache_dir(state, image):
+    path = f'{state.ccache}/{image}'
+    mkdirp(path)
+
+    # Replace atomically, concurrent builds may be reading it
+    tmp_path = f'{path}/ccache.conf.{os.getpid()}'
+    f = open(tmp_path, 'w')
+    print(f'max_size = {state.ccache_size}G', file=f)
+    f.close()
+    os.replace(tmp_path, f'{path}/ccache.conf')
+
+    return path
+
+
+# The ccache is shared by concurrent builds, so its own counters can't be
+# attributed to one build. Instead container-build.sh has ccache log the
+# result of each compilation, which is summarised here.
+def save_ccache_stats(path, elapsed):
+    stats = {'hits': 0, 'misses': 0, 'uncacheable': 0}
+    try:
+        lines = open(f'{path}/ccache-stats.log').read().splitlines()
+    except FileNotFoundError:
+        # Older ccache without stats_log support
+        return
+
+    results = []
+    for line in lines + ['#']:
+        if line.startswith('#'):
+            if results:
+                if any(r.endswith('cache_hit') for r in results):
+                    stats['hits'] += 1
+                elif 'cache_miss' in results:
+                    stats['misses'] += 1
+                else:
+                    stats['uncacheable'] += 1
+            results = []
+        elif line.strip():
+            results.append(line.strip())
+
+    # Hits are close to free, so estimate each hit saved the average time
+    # taken by a miss.
+    stats['elapsed'] = elapsed.total_seconds()
+    stats['saved'] = None
+    if stats['misses']:
+        stats['saved'] = stats['hits'] * stats['elapsed'] / stats['misses']
+
+    json.dump(stats, open(f'{path}/ccache.json', 'w'), indent=1)
+
+
+def log_ccache_stats(state, builds):
+    if not state.ccache or state.dry_run:
+        return
+
+    hits = misses = 0
+    saved = timedelta()
+    for job in builds:
+        if job.func != build_one_kernel or not job.result:
+            continue
+
+        try:
+            stats = json.load(open(f'{state.build_dir}/{job.name}/ccache.json'))
+        except (FileNotFoundError, ValueError):
+            continue
+
+        total = stats['hits'] + stats['misses']
+        if not total:
+            continue
+
+        rate = 100 * stats['hits'] / total
+        msg = f"ccache: {job.name}: {stats['hits']} hits, {stats['misses']} misses ({rate:.0f}% hit rate)"
+        if stats['saved'] is not None:
+            msg += f", ~{timedelta(seconds=int(stats['saved']))} saved"
+            saved += timedelta(seconds=int(stats['saved']))
+        logging.info(msg)
+
+        hits += stats['hits']
+        misses += stats['misses']
+
+    if hits + misses:
+        rate = 100 * hits / (hits + misses)
+        logging.info(f'ccache: total {hits} hits, {misses} misses ({rate:.0f}% hit rate), ~{saved} build time saved')
+
+
+def kernel_input_hash(state, kernel):
+    if state.src_tree is None:
+        return None
+
+    configs = kernel_configs(state, kernel)
+    if configs is None:
+        return None
+
+    return kernel_cache_key(state, kernel, configs)
+
+
+def selftests_input_hash(state, selftests):
+    if state.src_tree is None:
+        return None
+
+    script = f'{state.script_dir}/build/scripts/container-build.sh'
+    return cache_key([state.src_tree, selftests.name], [script])
+
+
+def boot_input_hash(state, boot):
+    if state.src_tree is None:
+        return None
+
+    inputs = [boot.dir_name(), boot.cmdline, kernel_input_hash(state, boot.kernel_build)]
+    for test in boot.tests:
+        inputs.append(test.name)
+        selftests = getattr(test, 'selftests', None)
+        if selftests:
+            inputs.append(selftests_input_hash(state, selftests))
+
+    script = f'{state.script_dir}/scripts/boot/{boot.script}'
+    if not os.path.exists(script):
+        return None
+
+    return cache_key(inputs, [script])
+
+
+# Hash everything that determines the build output: the source tree, the
+# config fragments, the image and build flags, and the build script itself.
+def kernel_cache_key(state, kernel, configs):
+    # Map the container paths from munge_configs() back to host paths
+    paths = []
+    for path in configs:
+        if path.startswith('/linux/'):
+            paths.append(f"{state.src}/{path[len('/linux/'):]}")
+        else:
+            paths.append(f"{state.config_dir}/{path[len('/configs/'):]}")
+
+    paths.append(f'{state.script_dir}/build/scripts/container-build.sh')
+
+    return cache_key([state.src_tree, kernel.subarch, kernel], paths)
+
+
+# munge_configs() logs what's wrong with a merge config, and each kernel's is
+# needed for its input hash, its boots' and its build, so only do it once.
+def kernel_configs(state, kernel):
+    key = tuple(kernel.merge_config)
+    if key not in state.merge_configs:
+        state.merge_configs[key] = munge_configs(state, kernel.merge_config)
+    return state.merge_configs[key]
+
+
 def munge_configs(state, merge_config):
     l = []
     for path in merge_config:
@@ -658,7 +1820,7 @@ def munge_configs(state, merge_config):
     return l
 
 
-def build_one_selftest(state, selftest, number, total):
+async def build_one_selftest(state, selftest, number, total):
     logging.info(f'Building {number}/{total} {selftest.target} for {selftest.full_image} ...')
 
     base_cmd = ['make', '--no-print-directory', '-C', f'{state.script_dir}/build']
@@ -667,6 +1829,15 @@ def build_one_selftest(state, selftest, number, total):
     base_cmd.append(f'JFACTOR={state.jfactor}')
     base_cmd.append('QUIET=1')
 
+    if state.jobserver_path:
+        base_cmd.append(f'JOBSERVER={state.jobserver_path}')
+
+    container = state.containers.get(selftest.image, None)
+    if container:
+        base_cmd.append(f"CONTAINER={container['name']}")
+
+    base_cmd.extend(cpuset_args(state))
+
     if selftest.target == 'ppctests':
         base_cmd.append('TARGETS=powerpc')
 
@@ -674,57 +1845,68 @@ def build_one_selftest(state, selftest, number, total):
     cmd.append('INSTALL=1')
     cmd.append(f'{selftest.target}@{selftest.full_image}')
 
+    job_result = JobResult()
+
     if not state.dry_run:
         # Clean so a failed build doesn't leave old artifacts lying around
         clean_cmd = copy(base_cmd)
         clean_cmd.append(f'clean-selftests@{selftest.full_image}')
         logging.debug(clean_cmd)
-        run(clean_cmd, stdin=DEVNULL, check=True)
+        with job_result.phase('clean'):
+            await run_async(clean_cmd, stdin=DEVNULL, check=True)
 
     ci_output_dir = f'{state.build_dir}/{selftest.output_dir}'
     mkdirp(ci_output_dir)
     log_path = f'{ci_output_dir}/log.txt'
     log = open(log_path, 'w')
+    job_result.log_path = log_path
 
     logging.debug(cmd)
 
     if state.dry_run:
-        return True
+        return job_result
 
     start = datetime.now()
-    result = run(cmd, stdout=log, stderr=log, stdin=DEVNULL)
+    with job_result.phase('build'):
+        result = await run_async(cmd, stdout=log, stderr=log, stdin=DEVNULL)
     end = datetime.now()
+    job_result.exit_codes['build'] = result.returncode
+    add_build_phases(job_result, log_path, f'{selftest.target} for {selftest.full_image}')
 
     if result.returncode != 0:
         log.close()
+        job_result.warnings = count_warnings(log_path)
         logging.error(colored(f'Failed building {selftest.target}', 'red'))
         logging.info(f'See: {log_path}')
         dump_log(log_path)
-        return False
+        return job_result.fail(f'Build exited with {result.returncode}')
 
     logging.info(f'{ok()} Build of {selftest.target} for {selftest.full_image} took {end - start}')
 
-    cmd = copy(base_cmd)
-    cmd.append(f'prune-selftests@{selftest.full_image}')
-    logging.debug(cmd)
-    run(cmd, stdout=log, stderr=log, stdin=DEVNULL, check=True)
+    print(f'Pruning non-outputs in {ci_output_dir}', file=log)
+    log.flush()
+    with job_result.phase('prune'):
+        result = await prune_selftests(state, ci_output_dir, log)
     log.close()
+    job_result.warnings = count_warnings(log_path)
 
-    return True
-
-def boot_kernels(test_suite, state):
-    if len(test_suite.boots) == 0:
-        return True
-
-    banner('Booting kernels ...')
+    if not result:
+        logging.error(colored(f'Failed packaging {selftest.target}', 'red'))
+        logging.info(f'See: {log_path}')
+        return job_result.fail('Packaging selftests failed')
 
-    mkdirp(f'{state.boot_dir}')
+    job_result.add_artifacts(ci_output_dir)
+    return job_result
 
-    n = 1
+def boot_jobs(test_suite, state, builds):
     jobs = []
     have_kvm = kvm_present()
     pattern = re.compile('\\bkvm\\b')
     for boot in test_suite.boots.values():
+        if state.shard and boot.kernel_build.name not in state.shard_items:
+            logging.debug(f'Skipping boot of {boot.name}, not in our shard')
+            continue
+
         if state.bfilter and not filter_matches(boot.name, state.bfilter):
             logging.debug(f'Skipping boot of {boot.name} due to filter')
             continue
@@ -733,42 +1915,78 @@ def boot_kernels(test_suite, state):
             logging.warn(colored(f'Skipping boot of {boot.name} due to KVM not present', 'yellow'))
             continue
 
+        reason = boot.unsupported(state)
+        if reason:
+            logging.warn(colored(f'Skipping boot of {boot.name}, {reason}', 'yellow'))
+            continue
+
+        if state.changed_files is not None and not boot_affected(state, boot):
+            logging.info(f'Skipping boot of {boot.name}, not affected by changes since {state.changed_since}')
+            continue
+
+        # Builds that were filtered out aren't dependencies, the boot just
+        # uses whatever artifacts are already there.
+        deps = []
+        kernel = builds.get(boot.kernel_build.name, None)
+        if kernel:
+            deps.append(kernel)
+
+        for test in boot.tests:
+            if state.tfilter and not filter_matches(test.name, state.tfilter):
+                continue
+
+            selftests = getattr(test, 'selftests', None)
+            if selftests and selftests.name in builds:
+                deps.append(builds[selftests.name])
+
+        name = boot.dir_name()
+        job = Job(name, boot_and_test, (state, boot), 'boot', deps,
+                  cost=job_cost(state, name, boot),
+                  input_hash=boot_input_hash(state, boot))
+
+        # If anything it depends on is being rebuilt it has to run again
+        if not len(deps) and resumable(state, job):
+            continue
+
         logging.debug(f'Adding boot job {boot.name}')
-        jobs.append(Job(boot_and_test, (state, boot)))
+        job.mem, job.cpus = boot.footprint(state)
+        jobs.append(job)
 
-    result = run_jobs(jobs, state.bfactor, test_suite.continue_on_error)
-    return result
+    return jobs
 
 
-def boot_and_test(state, boot, number, total):
+async def boot_and_test(state, boot, number, total):
     host_dir = f'{state.boot_dir}/{boot.dir_name()}'
     mkdirp(host_dir)
 
-    for test in boot.tests:
-        if state.tfilter and not filter_matches(test.name, state.tfilter):
-            logging.debug(f'Skipping test {test.name} due to filter')
-            continue
-        test_dir = f'{host_dir}/test-{test.name}'
-        mkdirp(test_dir)
-        test.setup(state, boot, test_dir)
+    job_result = JobResult()
+    with job_result.phase('setup'):
+        for test in boot.tests:
+            if state.tfilter and not filter_matches(test.name, state.tfilter):
+                logging.debug(f'Skipping test {test.name} due to filter')
+                continue
+            test_dir = f'{host_dir}/test-{test.name}'
+            mkdirp(test_dir)
+            test.setup(state, boot, test_dir)
 
     if state.skip_boot:
         logging.info('Skipping boot')
-    elif not boot_host(state, boot, host_dir, number, total):
-        return False
+    elif not await boot_host(state, boot, host_dir, number, total, job_result):
+        return job_result
 
-    return run_tests(state, boot, host_dir)
+    await run_tests(state, boot, host_dir, job_result)
+    return job_result
 
 
-def boot_host(state, boot, host_dir, number, total):
+async def boot_host(state, boot, host_dir, number, total, job_result):
     boot_script_path = f'{state.script_dir}/scripts/boot/{boot.script}'
     if not os.path.exists(boot_script_path):
         logging.error(f"Boot script '{boot_script_path}' doesn't exist")
-        return False
+        return job_result.fail(f"Boot script '{boot_script_path}' doesn't exist")
 
     if state.dry_run:
         logging.info(f'Would boot {boot.long_description()} ...')
-        return True
+        return job_result
 
     logging.info(f'Booting {number}/{total} {boot.long_description()} ...')
 
@@ -777,16 +1995,19 @@ def boot_host(state, boot, host_dir, number, total):
     if not os.path.exists(f'{artifact_dir}/vmlinux'):
         # vmlinux should exist even if we're booting a zImage/uImage
         logging.error(colored(f"Error: missing build artifacts for {boot.defconfig}", 'red'))
-        return False
+        return job_result.fail(f'Missing build artifacts for {boot.defconfig}')
 
     run(f'ln -sf -T {artifact_dir} artifacts'.split(), cwd=host_dir, check=True)
 
     boot_args = [
         f'--kernel-path {artifact_dir}/vmlinux',
-        f'--modules-path {artifact_dir}/modules.tar.gz',
         f'--release-path {artifact_dir}/kernel.release'
     ]
 
+    modules_path = modules_artifact(artifact_dir)
+    if modules_path:
+        boot_args.append(f'--modules-path {modules_path}')
+
     if boot.cmdline:
         boot_args.append(f'--cmdline {boot.cmdline}')
 
@@ -798,29 +2019,34 @@ def boot_host(state, boot, host_dir, number, total):
 
     log_path = f'{host_dir}/log.txt'
     log = open(log_path, 'w')
+    job_result.log_path = log_path
 
     start = datetime.now()
-    result = run(['./boot.sh'], cwd=host_dir, stdout=log, stderr=log, stdin=None)
+    with job_result.phase('boot'):
+        result = await run_async(['./boot.sh'], cwd=host_dir, stdout=log, stderr=log, stdin=None)
     end = datetime.now()
     log.close()
+    job_result.exit_codes['boot'] = result.returncode
+    job_result.warnings = count_warnings(log_path)
+    for name, phase_start, phase_end in parse_phase_markers(log_path):
+        job_result.add_span(f'qemu:{name}', phase_start, phase_end)
 
     if result.returncode != 0:
         logging.error(colored(f'Failed booting {boot.name}, took {end - start}', 'red'))
         logging.info(f'See: {log_path}')
         dump_log(log_path)
-        return False
+        return job_result.fail(f'Boot exited with {result.returncode}')
 
     logging.info(f'{ok()} Booted {boot.name}, took {end - start}')
-    return True
+    return job_result
 
 
-def run_tests(state, boot, host_dir):
-    result = True
+async def run_tests(state, boot, host_dir, job_result):
     for test in boot.tests:
         if not test.run:
             # Skip tests that only need to do setup, eg. qemu tests
             continue
-        
+
         if state.tfilter and not filter_matches(test.name, state.tfilter):
             logging.debug(f'Skipping test {test.name} due to filter')
             continue
@@ -835,9 +2061,16 @@ def run_tests(state, boot, host_dir):
         test_log_path = f'{test_dir}/log.txt'
         test_log = open(test_log_path, 'w')
 
+        test_result = JobResult()
+        test_result.log_path = test_log_path
+        job_result.tests.append((test.name, test_result))
+
         test_start = datetime.now()
-        proc = run(['./run.sh'], cwd=test_dir, stdout=test_log, stderr=test_log, stdin=None)
+        with test_result.phase('run'):
+            proc = await run_async(['./run.sh'], cwd=test_dir, stdout=test_log, stderr=test_log, stdin=None)
         test_end = datetime.now()
+        test_result.exit_codes['run'] = proc.returncode
+        job_result.phases[f'test:{test.name}'] = test_result.phases['run']
 
         if proc.returncode != 0:
             msg = f'Failed running test {test.name} on {boot.name} took {test_end - test_start}'
@@ -849,6 +2082,7 @@ def run_tests(state, boot, host_dir):
 
         print(msg, file=test_log)
         test_log.close()
+        test_result.warnings = count_warnings(test_log_path)
         host_log = open(f'{host_dir}/log.txt', 'a')
         print(msg, file=host_log)
         host_log.close()
@@ -856,9 +2090,10 @@ def run_tests(state, boot, host_dir):
         if proc.returncode != 0:
             logging.info(f'See: {test_log_path}')
             dump_log(test_log_path)
-            result = False
+            test_result.fail(f'Test exited with {proc.returncode}')
+            job_result.fail(f'Test {test.name} failed')
 
-    return result
+    return job_result
 
 
 def gen_script(fname, body):
@@ -888,56 +2123,440 @@ def dump_log(path, message=None):
 
 
 class Job:
-    def __init__(self, func, args):
+    def __init__(self, name, func, args, pool, deps=[], cost=0, input_hash=None, cleanup=None):
+        self.name = name
         self.func = func
         self.args = args
+        self.pool = pool
+        self.deps = deps
+        self.cost = cost
+        self.input_hash = input_hash
+        self.cleanup = cleanup
+        self.mem = 0                   # declared footprint, for admission control
+        self.cpus = 0
+        self.held_since = None
+        self.pin = True                # can be pinned to job.cpus CPUs
+        self.cpuset = None
+        self.slot = None               # which of the pool's slots it ran in
+        self.number = None             # position in its pool, for progress
+        self.start = None
+        self.end = None
+        self.result = None
+        self.cancelled = False
+
+    async def run(self, number, total):
+        # Each job runs in its own task, so this is only seen by this job
+        current_job.set(self)
+        return await self.func(*self.args, number, total)
+
+    def ready(self):
+        return all(dep.result is not None for dep in self.deps)
+
+    def deps_ok(self):
+        return all(dep.result for dep in self.deps)
+
+
+# The journal records the outcome of every job as it completes, one JSON
+# object per line, so an interrupted run can be resumed.
+def load_journal(path):
+    journal = {}
+    try:
+        for line in open(path):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Probably a partial line from an interrupted write
+                continue
+            journal[entry['job']] = entry
+    except FileNotFoundError:
+        pass
+
+    return journal
+
+
+def journal_append(state, job):
+    entry = {
+        'job': job.name,
+        'pool': job.pool,
+        'hash': job.input_hash,
+        'result': bool(job.result),
+        'time': job.end.isoformat(),
+    }
+
+    f = open(state.journal_path, 'a')
+    f.write(json.dumps(entry) + '\n')
+    f.close()
+
+
+# Check whether a job completed OK last time with the same inputs, and that
+# its artifacts are still there.
+def resumable(state, job, artifact=None):
+    if not state.resume or job.input_hash is None:
+        return False
+
+    entry = state.journal.get(job.name, None)
+    if entry is None or not entry['result'] or entry['hash'] != job.input_hash:
+        return False
+
+    if artifact and not os.path.exists(artifact):
+        return False
+
+    logging.info(f'Skipping {job.name}, completed in previous run')
+    return True
+
+
+def load_durations(path):
+    try:
+        return json.load(open(path))
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logging.warning(f'Ignoring corrupt durations file {path}')
+        return {}
+
+
+# Phases in which a job does the work its duration is meant to predict
+WORK_PHASES = ('build', 'boot')
+
+def record_duration(state, job):
+    # A build restored from the cache says nothing about how long it takes
+    # to build, and would hide the real duration once its inputs change.
+    phases = job.result.phases
+    if 'restore' in phases and 'build' not in phases:
+        return
+
+    # Only record jobs that actually built or booted something, a job that
+    # had nothing to do would make it look cheap next time.
+    if not any(phase in phases for phase in WORK_PHASES):
+        return
+
+    state.durations[job.name] = (job.end - job.start).total_seconds()
+
+    # Write the whole thing each time, it's small, and replace it atomically
+    # so an interrupted run doesn't lose the history.
+    tmp_path = f'{state.durations_path}.tmp'
+    json.dump(state.durations, open(tmp_path, 'w'), indent=1, sort_keys=True)
+    os.replace(tmp_path, state.durations_path)
+
+
+# Expected duration of a job, from previous runs if we've seen it before
+def job_cost(state, name, item):
+    cost = state.durations.get(name, None)
+    if cost is None:
+        cost = item.cost_estimate()
+    return cost
+
+
+# Longest first. A job's priority is its own cost plus the longest chain of
+# jobs waiting on it, so builds that gate long boots start early too.
+def job_priorities(jobs):
+    dependents = {}
+    for job in jobs:
+        for dep in job.deps:
+            dependents.setdefault(id(dep), []).append(job)
+
+    priorities = {}
+    def priority(job):
+        if id(job) not in priorities:
+            longest = max([priority(j) for j in dependents.get(id(job), [])], default=0)
+            priorities[id(job)] = job.cost + longest
+        return priorities[id(job)]
+
+    for job in jobs:
+        priority(job)
+
+    return priorities
+
+
+# How long cancelled jobs get to exit after SIGTERM before they're killed
+CANCEL_TIMEOUT = 30
+
+# How often to recheck whether jobs held back by admission control can start
+ADMISSION_POLL = 10
 
-    def run(self, number, total):
-        def f():
-            return sys.exit(0 if self.func(*self.args, number, total) else 1)
+# How often to log progress while jobs are running
+PROGRESS_INTERVAL = 60
 
-        self.proc = Process(target=f)
-        self.proc.start()
+# The job the current task is running, see Job.run()
+current_job = contextvars.ContextVar('current_job')
+
+
+# Remove whatever a cancelled build left behind, but keep its log
+def remove_partial_output(path):
+    if not os.path.isdir(path):
+        return
+
+    for name in os.listdir(path):
+        if name == 'log.txt':
+            continue
+
+        entry = f'{path}/{name}'
+        if os.path.isdir(entry) and not os.path.islink(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        else:
+            os.unlink(entry)
 
 
 # make -j in python ¯\_(ツ)_/¯
-def run_jobs(jobs, factor, continue_on_error):
-    if factor == 0:
-        factor = len(jobs)
+#
+# Each job runs in a pool, eg. 'build' or 'boot', and each pool has its own
+# limit on concurrent jobs. A job only starts once all its dependencies have
+# completed. Ready jobs are started longest first.
+async def run_jobs(jobs, factors, continue_on_error, stats=None, on_complete=None, admit=None, affinity=None):
+    pools = OrderedDict()
+    for job in jobs:
+        pool = pools.setdefault(job.pool, {'total': 0, 'n': 1, 'done': 0, 'running': 0,
+                                           'busy': timedelta(), 'slots': set()})
+        pool['total'] += 1
+
+    for name, pool in pools.items():
+        pool['factor'] = factors[name]
+        if pool['factor'] == 0:
+            pool['factor'] = pool['total']
 
-    n = 1
-    total = len(jobs)
     result = True
-    running = []
-
-    def wait_for_one_job(timeout=None):
-        job = running.pop(0)
-        job.proc.join(timeout)
-        if job.proc.exitcode is None:
-            # Didn't exit, put it at the back
-            running.append(job)
-            return None
-        return job.proc.exitcode == 0
+    priorities = job_priorities(jobs)
+    pending = sorted(jobs, key=lambda j: priorities[id(j)], reverse=True)
+    running = {}
+    start = datetime.now()
 
-    while len(jobs) and (result or continue_on_error):
-        while len(running) < factor and len(jobs):
+    def finish_job(task, cancelled=False):
+        job = running.pop(task)
+        job.end = datetime.now()
+        pool = pools[job.pool]
+        pool['running'] -= 1
+        pool['busy'] += job.end - job.start
+        pool['slots'].discard(job.slot)
+        if job.cpuset:
+            affinity.release(job.cpuset)
+
+        job.result = False
+        if task.cancelled():
+            cancelled = True
+        else:
             try:
-                job = jobs.pop(0)
-            except IndexError:
+                job.result = task.result()
+            except SlotLost as e:
+                # The slot it ran on is gone, so run it again in what's left.
+                # It keeps its number, it's the same job as far as progress
+                # and stats go.
+                pool['factor'] = max(pool['factor'] - e.slots, 0)
+                logging.error(colored(str(e), 'red'))
+                logging.warning(colored(f'Requeueing {job.name}, {pool["factor"]} {job.pool} slots left', 'yellow'))
+                job.result = None
+                pending.append(job)
+                pending.sort(key=lambda j: priorities[id(j)], reverse=True)
+                return True
+            except Exception:
+                logging.exception(colored(f'Error running {job.name}', 'red'))
+
+        if cancelled:
+            job.result = False
+            job.cancelled = True
+            if job.cleanup:
+                job.cleanup()
+
+        pool['done'] += 1
+        if on_complete:
+            on_complete(job)
+        return bool(job.result)
+
+    async def wait_for_jobs(timeout=None):
+        # Wait on every running job at once, so a slot is refilled as soon
+        # as any job finishes, not when it happens to be at the head.
+        logging.debug(f'Waiting for a job to complete, running = {len(running)}')
+        done, _ = await asyncio.wait(list(running.keys()), timeout=timeout,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        ok = True
+        for task in done:
+            ok &= finish_job(task)
+        return ok
+
+    async def cancel_jobs():
+        # Each job's commands are asked nicely to exit, then killed, see
+        # wait_async(), so wait for all of them to finish that.
+        for task, job in running.items():
+            logging.warning(colored(f'Cancelling {job.name}', 'yellow'))
+            task.cancel()
+
+        if len(running):
+            await asyncio.wait(list(running.keys()))
+        for task in list(running.keys()):
+            finish_job(task, cancelled=True)
+
+    async def show_progress():
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            l = [f"{name} {pool['done']}/{pool['total']} done, {pool['running']} running"
+                 for name, pool in pools.items()]
+            logging.info(f"Progress after {datetime.now() - start}: {'; '.join(l)}")
+
+    held = []
+    def start_jobs():
+        ok = True
+        held.clear()
+        for job in list(pending):
+            pool = pools[job.pool]
+            if pool['running'] >= pool['factor'] or not job.ready():
+                continue
+
+            if admit and job.deps_ok() and not admit(job, list(running.values())):
+                held.append(job)
+                continue
+
+            pending.remove(job)
+            if job.number is None:
+                job.number = pool['n']
+                pool['n'] += 1
+
+            if not job.deps_ok():
+                logging.error(colored(f'Skipping {job.name}, a dependency failed', 'red'))
+                job.result = False
+                pool['done'] += 1
+                ok = False
+                continue
+
+            if affinity and job.pin and job.cpus:
+                job.cpuset = affinity.allocate(job.cpus)
+                if job.cpuset:
+                    logging.debug(f'Pinning {job.name} to CPUs {format_cpu_list(job.cpuset)}')
+
+            job.slot = 0
+            while job.slot in pool['slots']:
+                job.slot += 1
+            pool['slots'].add(job.slot)
+
+            job.start = datetime.now()
+            task = asyncio.create_task(job.run(job.number, pool['total']))
+            running[task] = job
+            pool['running'] += 1
+            logging.debug(f'Started {job.pool} job {job.number}, running = {len(running)}')
+        return ok
+
+    progress = asyncio.create_task(show_progress())
+    try:
+        while len(pending) and (result or continue_on_error):
+            before = len(pending)
+            result &= start_jobs()
+            if len(running):
+                # If jobs are being held back, poll in case resources are
+                # freed by something other than one of our jobs finishing.
+                result &= await wait_for_jobs(ADMISSION_POLL if len(held) else None)
+            elif len(pending) == before:
+                # Nothing could be started, so nothing will ever complete
                 break
 
-            job.run(n, total)
-            running.append(job)
-            logging.debug(f'Started job {n}, running = {len(running)}')
-            n += 1
+        while len(running) and (result or continue_on_error):
+            result &= await wait_for_jobs()
+
+        # Something failed and the suite doesn't continue on error, so don't
+        # wait for the rest.
+        if len(running):
+            await cancel_jobs()
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        # Commands run in their own sessions so don't see the ^C
+        logging.error('Interrupted, cancelling running jobs')
+        await cancel_jobs()
+        raise
+    finally:
+        progress.cancel()
+
+    cancelled = [job.name for job in jobs if job.cancelled]
+    if len(cancelled):
+        logging.warning(colored(f"Cancelled: {' '.join(cancelled)}", 'yellow'))
+    if len(pending):
+        logging.warning(colored(f"Not started: {' '.join(job.name for job in pending)}", 'yellow'))
+        result = False
+
+    if stats is not None:
+        elapsed = datetime.now() - start
+        for name, pool in pools.items():
+            stats[name] = {
+                'jobs': pool['n'] - 1,
+                'slots': pool['factor'],
+                'elapsed': elapsed,
+                'busy': pool['busy'],
+                'idle': max(elapsed * pool['factor'] - pool['busy'], timedelta()),
+            }
 
-        logging.debug(f'Waiting for a job to complete, running = {len(running)}')
-        job_result = wait_for_one_job(10)
-        if job_result is not None:
-            result &= job_result
+    return result
 
-    while len(running):
-        logging.debug(f'Waiting for a job to complete, running = {len(running)}')
-        result &= wait_for_one_job()
 
-    return result
+# Run a command for the current job, see run_async()
+async def spawn_async(cmd, **kwargs):
+    job = current_job.get(None)
+    cpuset = job.cpuset if job else None
+
+    # Inherited by everything the command runs, except containers, see
+    # cpuset_args()
+    preexec_fn = None
+    if cpuset:
+        preexec_fn = lambda: os.sched_setaffinity(0, cpuset)
+
+    return await asyncio.create_subprocess_exec(*cmd, start_new_session=True,
+                                                preexec_fn=preexec_fn, **kwargs)
+
+
+async def wait_async(proc):
+    try:
+        return await proc.wait()
+    except asyncio.CancelledError:
+        await stop_async(proc)
+        raise
+
+
+# Ask nicely first, so containers and qemu get a chance to clean up, then
+# kill whatever is left, including anything that outlived the command itself.
+async def stop_async(proc, timeout=CANCEL_TIMEOUT):
+    signal_group(proc, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(proc.wait(), timeout)
+    except asyncio.TimeoutError:
+        job = current_job.get(None)
+        logging.warning(colored(f'Killing {job.name if job else proc.pid}', 'yellow'))
+    signal_group(proc, signal.SIGKILL)
+    await proc.wait()
+
+
+def signal_group(proc, sig):
+    try:
+        os.killpg(proc.pid, sig)
+    except OSError:
+        pass
+
+
+# Like subprocess.run(), but lets other jobs run meanwhile. Each command runs
+# in its own session, so if the job is cancelled the command and everything
+# it spawned can be signalled as a group.
+async def run_async(cmd, check=False, **kwargs):
+    proc = await spawn_async(cmd, **kwargs)
+    returncode = await wait_async(proc)
+    if check and returncode != 0:
+        raise CalledProcessError(returncode, cmd)
+
+    return CompletedProcess(cmd, returncode)
+
+
+# report.json has everything each job returned, report.xml is the same in
+# JUnit format for CI systems to consume. trace.json is a timeline of the
+# run, for Perfetto or chrome://tracing.
+def write_reports(state, jobs, start, end, extra_spans):
+    write_json_report(f'{state.output_dir}/report.json', state.suite_name, jobs, start, end)
+    write_junit_report(f'{state.output_dir}/report.xml', state.suite_name, jobs, start, end)
+    write_trace(f'{state.output_dir}/trace.json', state.suite_name, jobs, extra_spans)
+    logging.info(f'Reports written to {state.output_dir}/{{report.json,report.xml,trace.json}}')
+
+
+def log_job_stats(state):
+    for name, stats in state.job_stats.items():
+        if not stats.get('jobs', 0):
+            continue
+
+        slot_time = stats['elapsed'] * stats['slots']
+        if slot_time:
+            util = 100 * (stats['busy'] / slot_time)
+        else:
+            util = 100
+
+        logging.info(f"{name}: {stats['jobs']} jobs on {stats['slots']} slots in {stats['elapsed']}, "
+                     f"slot idle time {stats['idle']} ({util:.0f}% utilisation)")
@@ -1,10 +1,21 @@
 import argparse
+import asyncio
 import atexit
+import glob
+import json
 import os
+import pexpect
+import re
+import shutil
+import signal
 import sys
 import subprocess
 import logging
+import tempfile
+import time
+from hashlib import sha256
 from utils import *
+from disk_images import disk_image
 from pexpect_utils import PexpectHelper, standard_boot, ping_test, wget_test
 import qemu_callbacks
 
@@ -47,6 +58,14 @@ class QemuConfig:
         self.vmlinux = None
         self.cpuinfo = None
         self.bios = None
+        self.modules_tarball = None
+        self.selftests_tarball = None
+        self.snapshot_dir = None
+        self.qmp_path = None
+        self.unsupported = None
+        self.disk_images = None
+        self.modules_image = None
+        self.selftests_image = None
 
         # Detect root disks if we're called from scripts/boot/qemu-xxx
         base = os.path.dirname(sys.argv[0])
@@ -59,11 +78,62 @@ class QemuConfig:
     def machine_is(self, needle):
         return self.machine.startswith(needle)
 
+    # Everything that determines what guest gets booted. Two configs with the
+    # same key can share a booted guest, see GuestPool.
+    def guest_key(self):
+        return (self.qemu_cmd, self.machine, tuple(self.machine_caps), self.cpu,
+                self.smp, self.mem, self.accel, self.bios, self.net, self.vmlinux,
+                self.initrd, self.cloud_image, tuple(self.drives), tuple(self.cmdline),
+                tuple(self.extra_args), tuple(self.host_mounts), self.host_command,
+                self.modules_tarball, self.selftests_tarball, self.net_tests)
+
+    # A hash of everything that determines the state of the guest once it's
+    # booted to the prompt, naming its snapshot, or None if the guest can't be
+    # snapshotted. Guests with host mounts (9p blocks migration), cloud images
+    # (writable disks) or waiting for gdb aren't.
+    def snapshot_key(self):
+        if not self.snapshot_dir or not self.initrd or self.interactive:
+            return None
+
+        if self.cloud_image or self.host_mounts or '-S' in self.extra_args:
+            return None
+
+        # Snapshots only restore on the qemu version that saved them
+        version = get_qemu_version(self.qemu_cmd)
+        if version is None:
+            return None
+
+        build_id = get_build_id(self.vmlinux)
+        if build_id is None:
+            st = os.stat(self.vmlinux)
+            build_id = f'{os.path.abspath(self.vmlinux)}:{st.st_size}:{st.st_mtime}'
+
+        # The disks are read only, but the guest may have read from them
+        # while booting, so they have to be the same files.
+        files = [os.path.join(self.root_disk_path, self.initrd)]
+        for drive in self.drives:
+            m = re.search(r'file=([^,]+)', drive)
+            if m:
+                files.append(m.group(1))
+
+        h = sha256()
+        for val in [build_id, version[2], self.qemu_cmd,
+                    self.guest_key(), self.prompt]:
+            h.update(f'{val}\n'.encode('utf-8'))
+
+        for path in files:
+            st = os.stat(path)
+            h.update(f'{os.path.abspath(path)}:{st.st_size}:{st.st_mtime}\n'.encode('utf-8'))
+
+        return h.hexdigest()
+
     def configure_from_env(self):
         self.expected_release = get_expected_release()
         self.vmlinux = get_vmlinux()
         self.modules_tarball = get_modules_tarball()
         self.selftests_tarball = get_selftests_tarball()
+        self.snapshot_dir = get_env_var('QEMU_SNAPSHOT_DIR', None)
+        self.disk_images = get_env_var('QEMU_DISK_IMAGES', None)
 
     def configure_from_args(self, orig_args):
         parser = argparse.ArgumentParser()
@@ -90,6 +160,9 @@ class QemuConfig:
         parser.add_argument('--modules-path', type=str, help='Path to modules tarball')
         parser.add_argument('--selftests-path', type=str, help='Path to selftests tarball')
         parser.add_argument('--bios', type=str, help='BIOS option for qemu')
+        parser.add_argument('--snapshot-dir', type=str, help='Directory to cache guest snapshots in, to skip booting')
+        parser.add_argument('--disk-images', type=str, choices=['ext4', 'squashfs', 'erofs'],
+                            help='Pass modules/selftests as disk images of this format, rather than tarballs')
         parser.add_argument('--cap', dest='machine_caps',  type=str, default=[], action='append', help='Machine caps')
         parser.add_argument('--qemu-path', dest='qemu_path', type=str, help='Path to qemu bin directory')
         parser.add_argument('--root-disk-path', dest='root_disk_path', type=str, help='Path to root disk directory')
@@ -152,6 +225,12 @@ class QemuConfig:
         if args.selftests_path:
             self.selftests_tarball = args.selftests_path
 
+        if args.snapshot_dir:
+            self.snapshot_dir = args.snapshot_dir
+
+        if args.disk_images:
+            self.disk_images = args.disk_images
+
         self.compat_rootfs = args.compat_rootfs
         self.use_vof = args.use_vof
         self.quiet = args.quiet
@@ -273,12 +352,7 @@ class QemuConfig:
                 self.net = '-nic user'
 
         if self.machine == 'powernv':
-            if self.cpu and self.cpu.upper() == 'POWER8':
-                self.machine = 'powernv8'
-            elif self.cpu and self.cpu.upper() == 'POWER10':
-                self.machine = 'powernv10'
-            else:
-                self.machine = 'powernv9'
+            self.machine = powernv_machine(self.cpu)
 
         if self.cloud_image:
             self.login = True
@@ -333,11 +407,20 @@ class QemuConfig:
 
             self.boot_func = boot
 
+        # Converted on the host, falling back to the tarball if that fails
         if self.modules_tarball:
-            self.modules_drive = self.add_drive(f'file={self.modules_tarball},format=raw,readonly=on')
+            if self.disk_images:
+                self.modules_image = disk_image(self.modules_tarball, self.disk_images, 2)
+            path = self.modules_image or self.modules_tarball
+            self.modules_drive = self.add_drive(f'file={path},format=raw,readonly=on')
 
         if self.selftests_tarball:
-            self.selftests_drive = self.add_drive(f'file={self.selftests_tarball},format=raw,readonly=on')
+            if self.disk_images:
+                self.selftests_image = disk_image(self.selftests_tarball, self.disk_images, 1)
+            path = self.selftests_image or self.selftests_tarball
+            self.selftests_drive = self.add_drive(f'file={path},format=raw,readonly=on')
+
+        self.unsupported = qemu_unsupported(self.qemu_cmd, self.machine, self.cpu)
 
     def add_drive(self, args):
         drive_id = self.next_drive
@@ -402,7 +485,9 @@ class QemuConfig:
         self.machine_caps += ['cap-ccf-assist=off']
 
     def cmd(self):
-        logging.info('Using qemu version %s.%s "%s"' % get_qemu_version(self.qemu_cmd))
+        version = get_qemu_version(self.qemu_cmd)
+        if version:
+            logging.info('Using qemu version %s.%s "%s"' % version)
 
         machine = self.machine
         if len(self.machine_caps):
@@ -444,28 +529,297 @@ class QemuConfig:
 
         l.extend(self.extra_args)
 
+        # For control operations, so they don't go via the console
+        if self.qmp_path is None:
+            self.qmp_path = f'{tempfile.gettempdir()}/qemu-qmp-{os.getpid()}-{id(self)}.sock'
+            atexit.register(remove_file, self.qmp_path)
+        l.append('-qmp')
+        l.append(f'unix:{self.qmp_path},server=on,wait=off')
+
         logging.debug(l)
 
         return ' '.join(l)
 
 
-def qemu_monitor_shutdown(p):
-    p.send('\x01c') # invoke qemu monitor
-    p.expect(r'\(qemu\)')
-    p.send('quit')
+class QMPError(Exception):
+    pass
+
+
+# A minimal client for the QEMU Machine Protocol, see docs/interop/qmp-spec
+# in the qemu source. Events that arrive while waiting for a command to
+# return are kept in events.
+class QMPClient:
+    def __init__(self, path):
+        self.path = path
+        self.reader = None
+        self.writer = None
+        self.events = []
+
+    # qemu may not have created the socket yet if it's just been started
+    async def connect(self, timeout=10):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+        greeting = await self.read()
+        logging.debug(f'QMP greeting {greeting}')
+        await self.execute('qmp_capabilities')
+
+    async def read(self):
+        line = await self.reader.readline()
+        if not line:
+            raise QMPError('QMP connection closed')
+        return json.loads(line)
+
+    async def execute(self, command, arguments=None):
+        msg = {'execute': command}
+        if arguments:
+            msg['arguments'] = arguments
+
+        logging.debug(f'QMP sending {msg}')
+        self.writer.write(json.dumps(msg).encode('utf-8') + b'\n')
+        await self.writer.drain()
+
+        while True:
+            resp = await self.read()
+            if 'event' in resp:
+                self.events.append(resp)
+            elif 'error' in resp:
+                raise QMPError(f"{command}: {resp['error'].get('desc')}")
+            else:
+                return resp.get('return')
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, BrokenPipeError):
+                pass
+            self.writer = None
+
+
+# Connect to the guest's QMP socket and run func(client), eg:
+#   qmp_run(qconf, lambda client: client.execute('query-status'))
+def qmp_run(qconf, func, timeout=60):
+    async def run():
+        client = QMPClient(qconf.qmp_path)
+        try:
+            await client.connect()
+            return await asyncio.wait_for(func(client), timeout)
+        finally:
+            await client.close()
+
+    return asyncio.run(run())
+
+
+def qmp_execute(qconf, command, arguments=None):
+    return qmp_run(qconf, lambda client: client.execute(command, arguments))
+
+
+# The guest's run state, eg. 'running', 'paused', 'inmigrate', 'guest-panicked'
+def qmp_status(qconf):
+    return qmp_execute(qconf, 'query-status')['status']
+
+
+# Stop qemu immediately, for machines the guest can't power off
+def qmp_quit(qconf):
+    try:
+        qmp_execute(qconf, 'quit')
+    except (QMPError, OSError):
+        # qemu exits before replying sometimes, or has already gone
+        pass
+
+
+# Hot-plug the lowest numbered CPU core that isn't plugged, returning the id
+# of the new device, for qmp_unplug(). Needs spare slots, eg. -smp 2,maxcpus=4
+def qmp_hotplug_cpu(qconf):
+    cpus = qmp_execute(qconf, 'query-hotpluggable-cpus')
+    free = [cpu for cpu in cpus if 'qom-path' not in cpu]
+    if not free:
+        raise QMPError('No free CPU slots to hotplug into')
+
+    cpu = min(free, key=lambda cpu: cpu['props'].get('core-id', 0))
+    dev_id = f"hotplug-core{cpu['props'].get('core-id', 0)}"
+    args = {'driver': cpu['type'], 'id': dev_id}
+    args.update(cpu['props'])
+    qmp_execute(qconf, 'device_add', args)
+
+    return dev_id
+
+
+def qmp_unplug(qconf, dev_id):
+    qmp_execute(qconf, 'device_del', {'id': dev_id})
+
+
+def remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
 
+SNAPSHOT_CACHE_ENTRIES = 16
 
+# Save the state of the guest, which should be sitting at the prompt, to a
+# file by migrating it. The guest carries on running after.
+def qemu_save_snapshot(qconf, path, timeout):
+    phase_marker('snapshot')
+    start = time.time()
+    tmp = f'{path}.tmp-{os.getpid()}'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # It's migrated while it's running, so it's restored running. qemu stops
+    # it once the migration completes, so it has to be continued after.
+    async def save(client):
+        await client.execute('migrate', {'uri': f'exec:cat > {tmp}'})
+        while True:
+            status = (await client.execute('query-migrate')).get('status')
+            if status in ('completed', 'failed', 'cancelled'):
+                break
+            await asyncio.sleep(0.2)
+
+        await client.execute('cont')
+        return status
+
+    try:
+        status = qmp_run(qconf, save, timeout or 300)
+    except (QMPError, OSError, asyncio.TimeoutError) as e:
+        status = str(e)
+
+    if status == 'completed':
+        os.rename(tmp, path)
+        logging.info(f'Saved guest snapshot {path} in {time.time() - start:.1f}s')
+        prune_snapshots(os.path.dirname(path))
+    else:
+        logging.warning(f'Saving guest snapshot failed: {status}')
+        remove_file(tmp)
+
+
+# Snapshots are named by a hash of what went into them, so ones for old
+# kernels or configs are never used again, drop the least recently used.
+def prune_snapshots(path):
+    snapshots = sorted(glob.glob(f'{path}/*.state'), key=os.path.getmtime, reverse=True)
+    for old in snapshots[SNAPSHOT_CACHE_ENTRIES:]:
+        logging.debug(f'Removing old snapshot {old}')
+        remove_file(old)
+
+
+# What each qemu binary supports is cached, so it's only probed once per
+# binary, rather than by every boot, and so boots it can't do are skipped
+# without starting qemu. Entries are keyed by the binary's path and are
+# reprobed if it's modified (eg. rebuilt).
+CAPS_CACHE_PATH = os.path.expanduser(f"{os.environ.get('XDG_CACHE_HOME', '~/.cache')}/ci-scripts/qemu-caps.json")
+caps_memo = {}
+
+# Returns a dict with the version, machines and cpus, or None if the binary
+# can't be found or its version can't be determined.
+def qemu_capabilities(emulator):
+    path = shutil.which(emulator)
+    if path is None:
+        return None
+
+    path = os.path.realpath(path)
+    mtime = os.path.getmtime(path)
+    caps = caps_memo.get(path)
+    if caps and caps['mtime'] == mtime:
+        return caps
+
+    try:
+        cache = json.load(open(CAPS_CACHE_PATH))
+    except (OSError, ValueError):
+        cache = {}
+
+    caps = cache.get(path)
+    if caps is None or caps['mtime'] != mtime:
+        caps = probe_qemu(path)
+        if caps is None:
+            return None
+
+        caps['mtime'] = mtime
+        cache[path] = caps
+        try:
+            os.makedirs(os.path.dirname(CAPS_CACHE_PATH), exist_ok=True)
+            tmp = f'{CAPS_CACHE_PATH}.tmp-{os.getpid()}'
+            json.dump(cache, open(tmp, 'w'), indent=1)
+            os.replace(tmp, CAPS_CACHE_PATH)
+        except OSError as e:
+            logging.warning(f'Failed writing qemu capabilities cache: {e}')
+
+    caps_memo[path] = caps
+    return caps
+
+
+def probe_qemu(path):
+    logging.debug(f'Probing capabilities of {path}')
+
+    def output(*args):
+        return subprocess.run([path] + list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              stdin=subprocess.DEVNULL, text=True, timeout=60).stdout
+
+    m = re.search(r'QEMU emulator version (([0-9]+)\.([0-9]+)[^\n]*)', output('--version'))
+    if m is None:
+        logging.warning(f"Couldn't determine version of {path}")
+        return None
+
+    full, major, minor = m.groups()
+
+    # eg. "pseries              pSeries Logical Partition (alias of pseries-9.0)"
+    machines = []
+    for line in output('-machine', 'help').splitlines()[1:]:
+        words = line.split()
+        if words:
+            machines.append(words[0])
+
+    # eg. "PowerPC power9_v2.2     PVR 004e1202", names are case insensitive
+    cpus = []
+    for line in output('-cpu', 'help').splitlines():
+        words = line.split()
+        if len(words) > 1 and words[0] == 'PowerPC':
+            cpus.append(words[1].lower())
+
+    return {'version': [int(major), int(minor), full.strip()], 'machines': machines, 'cpus': cpus}
+
+
+# Returns (major, minor, full version), or None if it can't be determined
 def get_qemu_version(emulator):
-    p = PexpectHelper()
-    p.spawn('%s --version' % emulator, quiet=True)
-    p.expect(r'QEMU emulator version (([0-9]+)\.([0-9]+)[^\n]*)')
-    full, major, minor = p.matches()
-    return (int(major), int(minor), full.strip())
+    caps = qemu_capabilities(emulator)
+    if caps is None:
+        return None
+
+    return tuple(caps['version'])
+
+
+# Why qemu can't boot the machine/cpu, or None if it can or we can't tell
+def qemu_unsupported(emulator, machine, cpu=None):
+    caps = qemu_capabilities(emulator)
+    if caps is None:
+        return None
+
+    major, minor, _ = caps['version']
+    if machine not in caps['machines']:
+        return f'qemu {major}.{minor} does not support machine {machine}'
+
+    if cpu and cpu != 'host' and cpu.lower() not in caps['cpus']:
+        return f'qemu {major}.{minor} does not support CPU {cpu}'
+
+    return None
 
 
-def qemu_supports_p10(path):
-    major, _, _ = get_qemu_version(path)
-    return major >= 7
+# The powernv machine to use for the CPU
+def powernv_machine(cpu):
+    if cpu and cpu.upper() == 'POWER8':
+        return 'powernv8'
+    elif cpu and cpu.upper() == 'POWER10':
+        return 'powernv10'
+
+    return 'powernv9'
 
 
 def get_host_cpu():
@@ -514,96 +868,353 @@ def qemu_net_setup(p):
     p.cmd('ip route show')
 
 
-def qemu_main(qconf):
-    if qconf.expected_release is None or qconf.vmlinux is None:
-        return False
+# A booted guest. qemu_main() boots one, runs the callbacks on it and shuts it
+# down, GuestPool keeps one booted across several tests.
+class GuestSession:
+    def __init__(self, qconf):
+        self.qconf = qconf
+        self.key = qconf.guest_key()
+        self.p = None
+        self.boot_timeout = None
+        self.pexpect_timeout = None
+        self.log_offset = 0     # where the console log for the next test starts
 
-    for path in qconf.host_mounts:
-        if not os.path.isdir(path):
-            logging.error(f"Mount points must point to directories. Not found: '{path}'")
-            return False
+    def prepare(self):
+        qconf = self.qconf
+        if qconf.expected_release is None or qconf.vmlinux is None:
+            return None
 
-    qconf.prepare_cloud_image()
+        if qconf.unsupported:
+            logging.error(f"Can't boot: {qconf.unsupported}")
+            return None
 
-    cmd = qconf.cmd()
+        for path in qconf.host_mounts:
+            if not os.path.isdir(path):
+                logging.error(f"Mount points must point to directories. Not found: '{path}'")
+                return None
 
-    logging.info(f"Running '{cmd}'")
+        qconf.prepare_cloud_image()
+
+        cmd = qconf.cmd()
+
+        logging.info(f"Running '{cmd}'")
+
+        return cmd
+
+    def run_interactive(self):
+        cmd = self.prepare()
+        if cmd is None:
+            return False
 
-    if qconf.interactive:
         logging.info("Running interactively ...")
-        if qconf.host_mounts:
+        if self.qconf.host_mounts:
             logging.info("To mount host mount points run:")
             logging.info(" mkdir -p /mnt; mount -t 9p -o version=9p2000.L,trans=virtio host0 /mnt")
 
         rc = subprocess.run(cmd, shell=True).returncode
         return rc == 0
 
-    setup_timeout(10 * qconf.pexpect_timeout)
-    pexpect_timeout = qconf.pexpect_timeout
-    if pexpect_timeout:
-        boot_timeout = pexpect_timeout * 5
-    else:
-        boot_timeout = pexpect_timeout = None
+    def boot(self):
+        qconf = self.qconf
+        cmd = self.prepare()
+        if cmd is None:
+            return False
 
-    p = PexpectHelper()
-    logfile = open(qconf.logpath, 'w', encoding='utf-8', errors='ignore')
-    p.spawn(cmd, logfile=logfile, timeout=pexpect_timeout, quiet=qconf.quiet)
+        setup_timeout(10 * qconf.pexpect_timeout)
+        pexpect_timeout = qconf.pexpect_timeout
+        if pexpect_timeout:
+            boot_timeout = pexpect_timeout * 5
+        else:
+            boot_timeout = pexpect_timeout = None
 
-    p.push_prompt(qconf.prompt)
-    qconf.boot_func(p, boot_timeout, qconf)
+        self.boot_timeout = boot_timeout
+        self.pexpect_timeout = pexpect_timeout
 
-    logging.info(f'Looking for kernel version: {qconf.expected_release}')
-    p.send('echo "booted-revision: `uname -r`"')
-    p.expect(f'booted-revision: {qconf.expected_release}')
-    p.expect_prompt()
+        logfile = open(qconf.logpath, 'w', encoding='utf-8', errors='ignore')
 
-    p.send('cat /proc/cpuinfo')
-    if qconf.cpuinfo:
-        for s in qconf.cpuinfo:
-            p.expect(s)
-    p.expect_prompt()
+        key = qconf.snapshot_key()
+        if key:
+            snapshot = f'{qconf.snapshot_dir}/{key}.state'
+        else:
+            snapshot = None
+
+        if not (snapshot and os.path.exists(snapshot) and self.restore(cmd, snapshot, logfile)):
+            phase_marker('boot')
+            p = self.spawn(cmd, logfile)
+            qconf.boot_func(p, boot_timeout, qconf)
+
+            # Don't snapshot a guest that warned while booting, restoring it
+            # would hide the warnings.
+            if snapshot and not filter_log_warnings(open(qconf.logpath), open(os.devnull, 'w')):
+                qemu_save_snapshot(qconf, snapshot, boot_timeout)
+
+        p = self.p
+
+        phase_marker('check')
+        logging.info(f'Looking for kernel version: {qconf.expected_release}')
+        p.send('echo "booted-revision: `uname -r`"')
+        p.expect(f'booted-revision: {qconf.expected_release}')
+        p.expect_prompt()
+
+        p.send('cat /proc/cpuinfo')
+        if qconf.cpuinfo:
+            for s in qconf.cpuinfo:
+                p.expect(s)
+        p.expect_prompt()
+
+        # The times are logged to compare the image and tarball methods
+        if qconf.modules_tarball:
+            phase_marker('modules')
+            start = time.time()
+            p.cmd('mkdir -p /lib/modules')
+            if qconf.modules_image:
+                if not self.mount_image(qconf.modules_drive, '/lib/modules'):
+                    return False
+                method = f'mounted {qconf.disk_images} image'
+            else:
+                decompress = tarball_decompressor(qconf.modules_tarball)
+                p.send(f'cd /lib/modules; cat /dev/vd{qconf.modules_drive} | {decompress} | tar --strip-components=2 -xf -; cd -')
+                p.expect_prompt(timeout=boot_timeout)
+                method = 'extracted tarball'
+            logging.info(f'Modules {method} in {time.time() - start:.1f}s on {qconf.machine}')
+
+        if qconf.selftests_tarball:
+            phase_marker('selftests')
+            start = time.time()
+            p.cmd('mkdir -p /var/tmp/selftests')
+            if qconf.selftests_image:
+                # The selftests write into their directory, so copy them out
+                p.cmd('mkdir -p /var/tmp/selftests-image')
+                if not self.mount_image(qconf.selftests_drive, '/var/tmp/selftests-image'):
+                    return False
+                p.send('cp -a /var/tmp/selftests-image/. /var/tmp/selftests/')
+                p.expect_prompt(timeout=boot_timeout)
+                p.cmd('umount /var/tmp/selftests-image')
+                method = f'copied from {qconf.disk_images} image'
+            else:
+                decompress = tarball_decompressor(qconf.selftests_tarball)
+                p.send(f'cd /var/tmp/selftests; cat /dev/vd{qconf.selftests_drive} | {decompress} | tar --strip-components=1 -xf -; cd -')
+                p.expect_prompt(timeout=boot_timeout)
+                method = 'extracted tarball'
+            logging.info(f'Selftests {method} in {time.time() - start:.1f}s on {qconf.machine}')
 
-    if qconf.modules_tarball:
-        p.cmd('mkdir -p /lib/modules')
-        p.send(f'cd /lib/modules; cat /dev/vd{qconf.modules_drive} | zcat | tar --strip-components=2 -xf -; cd -')
-        p.expect_prompt(timeout=boot_timeout)
+        if qconf.net_tests:
+            phase_marker('net-tests')
+            qemu_net_setup(p)
+            ping_test(p)
 
-    if qconf.selftests_tarball:
-        p.cmd('mkdir -p /var/tmp/selftests')
-        p.send(f'cd /var/tmp/selftests; cat /dev/vd{qconf.selftests_drive} | zcat | tar --strip-components=1 -xf -; cd -')
-        p.expect_prompt(timeout=boot_timeout)
+        if qconf.host_mounts:
+            phase_marker('host-command')
+            # Clear timeout, we don't know how long it will take
+            setup_timeout(0)
+
+            for i in range(0, len(qconf.host_mounts)):
+                p.cmd(f'mkdir -p /mnt/host{i}')
+                p.cmd(f'mount -t 9p -o version=9p2000.L,trans=virtio host{i} /mnt/host{i}')
+
+            for i in range(0, len(qconf.host_mounts)):
+                p.send(f'[ -x /mnt/host{i}/{qconf.host_command} ] && (cd /mnt/host{i} && ./{qconf.host_command})')
+                p.expect_prompt(timeout=None) # no timeout
+
+        return True
+
+    def spawn(self, cmd, logfile):
+        p = PexpectHelper()
+        self.p = p
+        p.spawn(cmd, logfile=logfile, timeout=self.pexpect_timeout, quiet=self.qconf.quiet)
+
+        # If we're cancelled take qemu down too, rather than leaving it running
+        def terminate_handler(signum, frame):
+            logging.error('Terminated, stopping qemu')
+            p.child.terminate(force=True)
+            sys.exit(1)
+
+        signal.signal(signal.SIGTERM, terminate_handler)
+
+        p.push_prompt(self.qconf.prompt)
+        return p
+
+    # Start the guest from a snapshot of it sitting at the prompt, rather than
+    # booting it. Returns False if that didn't work, having removed the
+    # snapshot, so the caller can boot normally.
+    def restore(self, cmd, snapshot, logfile):
+        phase_marker('restore')
+        start = time.time()
+        logging.info(f'Restoring guest from {snapshot}')
+        # Mark as recently used
+        os.utime(snapshot)
+        p = self.spawn(f'{cmd} -incoming "exec:cat {snapshot}"', logfile)
+
+        # Wait for the incoming migration to finish, qemu exits if it fails.
+        # A guest saved while paused is restored paused, so continue it.
+        async def wait_running(client):
+            while True:
+                status = (await client.execute('query-status'))['status']
+                if status == 'running':
+                    return
+                if status in ('postmigrate', 'internal-error', 'guest-panicked'):
+                    raise QMPError(f'Restored guest is {status}')
+                if status == 'paused':
+                    await client.execute('cont')
+                await asyncio.sleep(0.1)
 
-    if qconf.net_tests:
-        qemu_net_setup(p)
-        ping_test(p)
+        try:
+            qmp_run(self.qconf, wait_running, self.boot_timeout or 300)
+            # Nothing is printed when the guest resumes, poke it for a prompt
+            p.send('')
+            i = p.child.expect([p.prompt, pexpect.EOF, pexpect.TIMEOUT], timeout=self.pexpect_timeout)
+        except (QMPError, OSError, asyncio.TimeoutError) as e:
+            logging.debug(f'Waiting for restored guest: {e}')
+            i = -1
+
+        if i == 0:
+            logging.info(f'Restored guest in {time.time() - start:.1f}s')
+            return True
+
+        logging.warning(f'Restoring from {snapshot} failed, removing it and booting')
+        self.kill()
+        remove_file(snapshot)
 
-    if qconf.host_mounts:
-        # Clear timeout, we don't know how long it will take
-        setup_timeout(0)
+        return False
 
-        for i in range(0, len(qconf.host_mounts)):
-            p.cmd(f'mkdir -p /mnt/host{i}')
-            p.cmd(f'mount -t 9p -o version=9p2000.L,trans=virtio host{i} /mnt/host{i}')
+    def mount_image(self, drive, path):
+        p = self.p
+        p.send(f'mount -t {self.qconf.disk_images} -o ro /dev/vd{drive} {path} || echo "mount failed: $?"')
+        if p.expect([r'mount failed: \d+', p.prompt]) == 0:
+            p.expect_prompt()
+            logging.error(f'Failed mounting {self.qconf.disk_images} image on {path}, is it enabled in the kernel?')
+            return False
 
-        for i in range(0, len(qconf.host_mounts)):
-            p.send(f'[ -x /mnt/host{i}/{qconf.host_command} ] && (cd /mnt/host{i} && ./{qconf.host_command})')
-            p.expect_prompt(timeout=None) # no timeout
+        return True
 
-    for callback in qconf.callbacks:
+    def run(self, callback):
         logging.info("Running callback ...")
-        if callback(qconf, p) is False:
+        if callback(self.qconf, self.p) is False:
             logging.error("Callback failed")
             return False
 
-    if qconf.shutdown:
-        qconf.shutdown(p)
-    else:
-        p.send('poweroff')
+        return True
+
+    # Check the console log since the last check, so a reused guest's
+    # warnings are blamed on the test that caused them.
+    def warnings_seen(self):
+        infile = open(self.qconf.logpath, encoding='utf-8', errors='ignore')
+        infile.seek(self.log_offset)
+        mode = 'a' if self.log_offset else 'w'
+        found = filter_log_warnings(infile, open('warnings.txt', mode))
+        self.log_offset = infile.tell()
+        if found:
+            logging.error('Errors/warnings seen in console log')
+
+        return found
+
+    def shutdown(self):
+        phase_marker('shutdown')
+        if self.qconf.shutdown:
+            self.qconf.shutdown(self.p)
+        else:
+            self.p.send('poweroff')
+
+        self.p.wait_for_exit(timeout=self.boot_timeout)
+        phase_marker('end')
+
+        return not self.warnings_seen()
+
+    def alive(self):
+        try:
+            status = qmp_status(self.qconf)
+        except (QMPError, OSError, asyncio.TimeoutError) as e:
+            logging.debug(f'Querying guest status: {e}')
+            return False
+
+        logging.debug(f'Guest status is {status}')
+        return status == 'running'
+
+    def kill(self):
+        if self.p and self.p.child and self.p.child.isalive():
+            self.p.child.terminate(force=True)
+
+
+# Boots a guest once and runs successive tests on it, rather than booting a
+# fresh guest for each test. The guest is rebooted when a test wants a
+# differently configured guest, when a test fails, or when a test declares it
+# taints the guest (eg. by deliberately crashing the kernel).
+class GuestPool:
+    def __init__(self):
+        self.session = None
+        self.ok = True      # whether every guest shut down cleanly
+        self.boots = 0
+        self.reuses = 0
+
+    def run(self, qconf, callback, taints=False):
+        session = self.session
+        if session and session.key != qconf.guest_key():
+            self.close()
+            session = None
+
+        if session is None:
+            session = GuestSession(qconf)
+            self.boots += 1
+            if not session.boot():
+                session.kill()
+                return False
+            self.session = session
+        elif not session.alive():
+            logging.info('Guest is no longer running, rebooting')
+            session.kill()
+            self.session = None
+            return self.run(qconf, callback, taints)
+        else:
+            logging.info('Reusing booted guest')
+            self.reuses += 1
+            setup_timeout(10 * qconf.pexpect_timeout)
+
+        phase_marker('callbacks')
+        ok = session.run(callback) and not session.warnings_seen()
+        if not ok:
+            logging.info('Test failed, discarding guest')
+            self.session = None
+            session.kill()
+        elif taints:
+            logging.info('Test taints the guest, shutting it down')
+            ok = self.close()
+
+        return ok
+
+    def close(self):
+        if self.session:
+            session = self.session
+            self.session = None
+            if not session.shutdown():
+                self.ok = False
+                return False
+
+            logging.info('Guest shut down OK')
 
-    p.wait_for_exit(timeout=boot_timeout)
+        return True
+
+    def finish(self):
+        self.close()
+        logging.info(f'Booted {self.boots} guest(s), reused them {self.reuses} time(s)')
+        return self.ok
+
+
+def qemu_main(qconf):
+    session = GuestSession(qconf)
+
+    if qconf.interactive:
+        return session.run_interactive()
+
+    if not session.boot():
+        return False
+
+    if qconf.callbacks:
+        phase_marker('callbacks')
+    for callback in qconf.callbacks:
+        if not session.run(callback):
+            return False
 
-    if filter_log_warnings(open(qconf.logpath), open('warnings.txt', 'w')):
-        logging.error('Errors/warnings seen in console log')
+    if not session.shutdown():
         return False
 
     logging.info('Test completed OK')
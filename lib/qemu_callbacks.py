@@ -99,6 +99,34 @@ def lkdtm_selftests(qconf, p, arg=None):
 
     return __run_selftests(qconf, p, collections=['lkdtm'])
 
+
+# Hot-plug a CPU core via QMP and check the guest brings it online
+# eg. --smp 2,maxcpus=4 --callback hotplug_cpu
+def hotplug_cpu(qconf, p):
+    from qemu import qmp_hotplug_cpu
+
+    p.send('echo "cpus-before: $(grep -c ^processor /proc/cpuinfo)"')
+    p.expect(r'cpus-before: (\d+)')
+    before = int(p.matches()[0])
+    p.expect_prompt()
+
+    dev_id = qmp_hotplug_cpu(qconf)
+    logging.info(f'Hotplugged {dev_id}')
+
+    # The guest onlines the new CPUs asynchronously
+    p.send(f'for i in $(seq 30); do [ $(grep -c ^processor /proc/cpuinfo) -gt {before} ] && break; sleep 1; done')
+    p.expect_prompt(timeout=60)
+    p.send('echo "cpus-after: $(grep -c ^processor /proc/cpuinfo)"')
+    p.expect(r'cpus-after: (\d+)')
+    after = int(p.matches()[0])
+    p.expect_prompt()
+
+    if after <= before:
+        logging.error(f'Hotplugged CPU not seen by guest, still {after} CPUs')
+        return False
+
+    return True
+
 ########################################
 # Helper functions
 ########################################
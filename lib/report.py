@@ -0,0 +1,181 @@
+import json
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+
+
+# What a job did, returned by the build/boot/test functions. It's truthy if
+# the job succeeded, so callers that only care about that can treat it as a
+# bool.
+class JobResult:
+    def __init__(self, ok=True, reason=None):
+        self.ok = ok
+        self.reason = reason            # why it failed
+        self.phases = OrderedDict()     # phase -> seconds
+        self.spans = []                 # (phase, start, end) in epoch seconds
+        self.exit_codes = OrderedDict() # command -> exit code
+        self.artifacts = OrderedDict()  # artifact -> size in bytes
+        self.warnings = 0               # warnings in the log
+        self.log_path = None
+        self.tests = []                 # JobResults of tests run, named
+
+    def __bool__(self):
+        return self.ok
+
+    def fail(self, reason):
+        self.ok = False
+        self.reason = reason
+        return self
+
+    # Time a phase of the job, eg. with result.phase('build'): ...
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add_span(self, name, start, end):
+        self.phases[name] = round(self.phases.get(name, 0) + end - start, 3)
+        self.spans.append((name, start, end))
+
+    def add_artifacts(self, path):
+        for name in sorted(os.listdir(path)):
+            full = f'{path}/{name}'
+            if os.path.isfile(full):
+                self.artifacts[name] = os.path.getsize(full)
+
+    def to_dict(self):
+        d = OrderedDict()
+        d['ok'] = self.ok
+        d['reason'] = self.reason
+        d['phases'] = self.phases
+        d['spans'] = self.spans
+        d['exit_codes'] = self.exit_codes
+        d['artifacts'] = self.artifacts
+        d['warnings'] = self.warnings
+        d['log'] = self.log_path
+        if self.tests:
+            d['tests'] = [dict(name=name, **test.to_dict()) for name, test in self.tests]
+        return d
+
+    @staticmethod
+    def from_dict(d):
+        result = JobResult(d['ok'], d['reason'])
+        result.phases.update(d['phases'])
+        result.spans = [tuple(span) for span in d.get('spans', [])]
+        result.exit_codes.update(d['exit_codes'])
+        result.artifacts.update(d['artifacts'])
+        result.warnings = d['warnings']
+        result.log_path = d['log']
+        for test in d.get('tests', []):
+            result.tests.append((test['name'], JobResult.from_dict(test)))
+        return result
+
+
+class Phase:
+    def __init__(self, result, name):
+        self.result = result
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.result.add_span(self.name, self.start, time.time())
+        return False
+
+
+WARNING_PATTERN = re.compile(rb'\bwarning:', re.IGNORECASE)
+
+def count_warnings(path):
+    count = 0
+    try:
+        for line in open(path, 'rb'):
+            if WARNING_PATTERN.search(line):
+                count += 1
+    except FileNotFoundError:
+        pass
+
+    return count
+
+
+def job_status(job):
+    if job.cancelled:
+        return 'cancelled'
+    if job.start is None:
+        return 'skipped' if job.result is not None else 'not run'
+    return 'passed' if job.result else 'failed'
+
+
+def job_duration(job):
+    if job.start is None or getattr(job, 'end', None) is None:
+        return 0
+    return round((job.end - job.start).total_seconds(), 3)
+
+
+def write_json_report(path, suite, jobs, start, end):
+    report = OrderedDict()
+    report['suite'] = suite
+    report['start'] = start.isoformat()
+    report['end'] = end.isoformat()
+    report['jobs'] = []
+
+    for job in jobs:
+        entry = OrderedDict()
+        entry['name'] = job.name
+        entry['pool'] = job.pool
+        entry['status'] = job_status(job)
+        entry['deps'] = [dep.name for dep in job.deps]
+        entry['duration'] = job_duration(job)
+        if isinstance(job.result, JobResult):
+            entry.update(job.result.to_dict())
+        report['jobs'].append(entry)
+
+    write_atomic(path, json.dumps(report, indent=1))
+
+
+# One testsuite per pool, one testcase per job, plus one per test run by a
+# boot job, named after the boot.
+def write_junit_report(path, suite, jobs, start, end):
+    root = ET.Element('testsuites', name=suite, timestamp=start.isoformat(),
+                      time=str((end - start).total_seconds()))
+
+    suites = OrderedDict()
+    for job in jobs:
+        cases = suites.setdefault(job.pool, [])
+        cases.append((job.pool, job.name, job_status(job), job_duration(job), job.result))
+        if isinstance(job.result, JobResult):
+            for name, test in job.result.tests:
+                status = 'passed' if test else 'failed'
+                cases.append((job.name, name, status, sum(test.phases.values()), test))
+
+    for pool, cases in suites.items():
+        ts = ET.SubElement(root, 'testsuite', name=f'{suite}.{pool}', tests=str(len(cases)))
+        counts = {'failures': 0, 'skipped': 0}
+        for classname, name, status, duration, result in cases:
+            tc = ET.SubElement(ts, 'testcase', classname=classname, name=name, time=str(duration))
+            if status in ('failed', 'cancelled'):
+                counts['failures'] += 1
+                reason = status
+                if isinstance(result, JobResult) and result.reason:
+                    reason = result.reason
+                failure = ET.SubElement(tc, 'failure', message=reason)
+                if isinstance(result, JobResult) and result.log_path:
+                    failure.text = f'See: {result.log_path}'
+            elif status in ('skipped', 'not run'):
+                counts['skipped'] += 1
+                ET.SubElement(tc, 'skipped', message=status)
+
+        for key, val in counts.items():
+            ts.set(key, str(val))
+
+    ET.indent(root)
+    write_atomic(path, ET.tostring(root, encoding='unicode', xml_declaration=True) + '\n')
+
+
+def write_atomic(path, data):
+    tmp_path = f'{path}.tmp'
+    f = open(tmp_path, 'w')
+    f.write(data)
+    f.close()
+    os.replace(tmp_path, path)
@@ -0,0 +1,57 @@
+import asyncio
+import ngci
+from admission import AdmissionControl
+
+
+class Refuse(AdmissionControl):
+    def __init__(self, refused):
+        super().__init__(0, patience=0)
+        self.refused = refused
+
+    def check(self, job, running):
+        if job.name in self.refused:
+            return 'refused'
+        return None
+
+
+def test_starved_job_admitted_when_idle():
+    admission = Refuse(['big'])
+    big = ngci.Job('big', None, (), 'build')
+    small = ngci.Job('small', None, (), 'build')
+
+    # Held twice, so it's starved
+    assert not admission.admit(big, [small])
+    assert not admission.admit(big, [small])
+    assert admission.starved is big
+    assert not admission.admit(small, [])
+
+    # Nothing's running, so it starts and is no longer starved
+    assert admission.admit(big, [])
+    assert admission.starved is None
+    assert admission.admit(small, [big])
+
+
+def test_jobs_not_serialised_after_starved_job_starts(monkeypatch):
+    monkeypatch.setattr(ngci, 'ADMISSION_POLL', 0.01)
+
+    running = set()
+    overlap = {}
+
+    async def work(name, number, total):
+        running.add(name)
+        overlap[name] = set(running)
+        await asyncio.sleep(0.1)
+        running.discard(name)
+        return True
+
+    first = ngci.Job('first', work, ('first',), 'build', cost=3)
+    big = ngci.Job('big', work, ('big',), 'build', cost=2)
+    after = [ngci.Job(name, work, (name,), 'build', [first], cost=1) for name in ['a', 'b']]
+    admission = Refuse(['big'])
+
+    # big is held back until first finishes, by which time it's starved
+    ok = asyncio.run(ngci.run_jobs([first, big] + after, {'build': 0}, False,
+                                   admit=admission.admit))
+    assert ok
+    assert admission.starved is None
+    assert overlap['b'] == {'big', 'a', 'b'}
@@ -0,0 +1,151 @@
+import os
+import sys
+import qemu
+from qemu import QemuConfig, GuestSession, qemu_save_snapshot, qmp_execute
+
+
+# Enough of qemu to boot to a prompt, and save and restore the guest over
+# QMP. Like qemu, a guest saved while paused is restored paused, and the
+# console doesn't respond until the guest is running.
+FAKE_QEMU = r'''
+import json, os, socket, sys, threading, time
+
+args = sys.argv[1:]
+if args == ['--version']:
+    print('QEMU emulator version 8.2.0')
+    sys.exit(0)
+if args == ['-machine', 'help']:
+    print('Supported machines are:\npseries              pSeries Logical Partition')
+    sys.exit(0)
+if args == ['-cpu', 'help']:
+    print('PowerPC power9_v2.2      PVR 004e1202\nPowerPC power9           (alias for power9_v2.2)')
+    sys.exit(0)
+
+state = {'status': 'running'}
+path = args[args.index('-qmp') + 1].split(',')[0][len('unix:'):]
+
+def serve():
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX)
+    server.bind(path)
+    server.listen(1)
+    while True:
+        conn, _ = server.accept()
+        f = conn.makefile('rw')
+        f.write(json.dumps({'QMP': {'version': {}}}) + '\n')
+        f.flush()
+        for line in f:
+            msg = json.loads(line)
+            cmd = msg['execute']
+            ret = {}
+            if cmd == 'query-status':
+                ret = {'status': state['status'], 'running': state['status'] == 'running'}
+            elif cmd == 'stop':
+                state['status'] = 'paused'
+            elif cmd == 'cont':
+                state['status'] = 'running'
+            elif cmd == 'migrate':
+                dest = msg['arguments']['uri'].split('> ')[1]
+                json.dump({'running': state['status'] == 'running'}, open(dest, 'w'))
+                state['status'] = 'postmigrate'
+            elif cmd == 'query-migrate':
+                ret = {'status': 'completed'}
+            f.write(json.dumps({'return': ret}) + '\n')
+            f.flush()
+
+threading.Thread(target=serve, daemon=True).start()
+
+if '-incoming' in args:
+    state['status'] = 'inmigrate'
+    saved = json.load(open(args[args.index('-incoming') + 1].split('cat ')[1]))
+    time.sleep(0.2)
+    state['status'] = 'running' if saved['running'] else 'paused'
+else:
+    print('Freeing unused kernel memory')
+    sys.stdout.write('~ # ')
+
+while True:
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line:
+        break
+    while state['status'] != 'running':
+        time.sleep(0.1)
+    if line.strip() == 'poweroff':
+        sys.exit(0)
+    if line.startswith('echo "booted-revision'):
+        print('booted-revision: 6.0.0')
+    elif line.strip() == 'cat /proc/cpuinfo':
+        print('machine : IBM pSeries (emulated by qemu)')
+    sys.stdout.write('~ # ')
+'''
+
+
+def guest_config(tmp_path):
+    qconf = QemuConfig('pseries')
+    qconf.qemu_path = str(tmp_path / 'bin')
+    qconf.root_disk_path = str(tmp_path)
+    qconf.initrd = 'initrd'
+    qconf.vmlinux = str(tmp_path / 'vmlinux')
+    qconf.expected_release = '6.0.0'
+    qconf.snapshot_dir = str(tmp_path / 'snapshots')
+    qconf.pexpect_timeout = 2
+    qconf.quiet = True
+    qconf.apply_defaults()
+    return qconf
+
+
+def setup_guest(tmp_path, monkeypatch):
+    os.mkdir(tmp_path / 'bin')
+    emulator = tmp_path / 'bin' / 'qemu-system-ppc64'
+    emulator.write_text(f'#!{sys.executable}\n{FAKE_QEMU}')
+    emulator.chmod(0o755)
+    for name in ['initrd', 'vmlinux']:
+        (tmp_path / name).write_text(name)
+
+    monkeypatch.chdir(tmp_path)
+    # For finding etc/filters.ini
+    monkeypatch.setattr(sys, 'argv', [__file__])
+    monkeypatch.setattr(qemu, 'CAPS_CACHE_PATH', str(tmp_path / 'caps.json'))
+    monkeypatch.setattr(qemu, 'setup_timeout', lambda seconds: None)
+
+    restored = []
+    restore = GuestSession.restore
+    def spy(self, *args):
+        restored.append(restore(self, *args))
+        return restored[-1]
+    monkeypatch.setattr(GuestSession, 'restore', spy)
+
+    return restored
+
+
+def test_restore_snapshot(tmp_path, monkeypatch):
+    restored = setup_guest(tmp_path, monkeypatch)
+
+    for i in range(2):
+        session = GuestSession(guest_config(tmp_path))
+        assert session.boot()
+        assert session.shutdown()
+
+    assert len(os.listdir(tmp_path / 'snapshots')) == 1
+    assert restored == [True]
+
+
+def test_restore_paused_snapshot(tmp_path, monkeypatch):
+    restored = setup_guest(tmp_path, monkeypatch)
+
+    qconf = guest_config(tmp_path)
+    session = GuestSession(qconf)
+    assert session.boot()
+
+    # Replace the snapshot with one of the guest paused
+    snapshot = f'{qconf.snapshot_dir}/{qconf.snapshot_key()}.state'
+    qmp_execute(qconf, 'stop')
+    qemu_save_snapshot(qconf, snapshot, 10)
+    assert session.shutdown()
+
+    session = GuestSession(guest_config(tmp_path))
+    assert session.boot()
+    assert session.shutdown()
+    assert restored == [True]
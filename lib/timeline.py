@@ -0,0 +1,87 @@
+import json
+import re
+
+from report import write_atomic
+
+
+# Lines of the form "## PHASE <name> <epoch seconds>" mark the start of a
+# phase, which lasts until the next marker. A phase named "end" just marks
+# the end of the previous phase. See phase_marker() in utils.py.
+PHASE_MARKER = re.compile(r'^## PHASE (\S+) (\d+(?:\.\d+)?)\s*$')
+
+def parse_phase_markers(path):
+    markers = []
+    try:
+        for line in open(path, errors='ignore'):
+            m = PHASE_MARKER.match(line)
+            if m:
+                markers.append((m.group(1), float(m.group(2))))
+    except FileNotFoundError:
+        pass
+
+    spans = []
+    for (name, start), (_, end) in zip(markers, markers[1:]):
+        if name != 'end':
+            spans.append((name, start, end))
+
+    return spans
+
+
+def usecs(epoch):
+    return int(epoch * 1000000)
+
+
+# Write a trace in the Chrome trace event format, viewable in Perfetto or
+# chrome://tracing. Each pool is a process and each of its slots a thread,
+# so a track shows what one slot was doing over the run. A job's phases,
+# and the tests a boot ran, are nested under the job.
+#
+# extra is a list of (track, name, start, end) for things done outside of
+# jobs, eg. starting containers.
+def write_trace(path, suite, jobs, extra=[]):
+    events = []
+    pids = {}
+
+    def pid_of(track):
+        if track not in pids:
+            pids[track] = len(pids) + 1
+            events.append({'ph': 'M', 'name': 'process_name', 'pid': pids[track], 'tid': 0,
+                           'args': {'name': track}})
+        return pids[track]
+
+    tids = set()
+    def span(pid, tid, name, start, end, args=None):
+        if (pid, tid) not in tids:
+            tids.add((pid, tid))
+            events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid,
+                           'args': {'name': f'slot {tid}'}})
+
+        event = {'ph': 'X', 'name': name, 'pid': pid, 'tid': tid,
+                 'ts': usecs(start), 'dur': max(usecs(end) - usecs(start), 0)}
+        if args:
+            event['args'] = args
+        events.append(event)
+
+    for track, name, start, end in extra:
+        span(pid_of(track), 0, name, start.timestamp(), end.timestamp())
+
+    for job in jobs:
+        if job.start is None or job.end is None:
+            continue
+
+        pid = pid_of(job.pool)
+        args = {'result': bool(job.result), 'cancelled': job.cancelled}
+        span(pid, job.slot, job.name, job.start.timestamp(), job.end.timestamp(), args)
+
+        result = job.result
+        if not hasattr(result, 'spans'):
+            continue
+
+        for name, start, end in result.spans:
+            span(pid, job.slot, name, start, end)
+        for test_name, test in result.tests:
+            for name, start, end in test.spans:
+                span(pid, job.slot, test_name, start, end, {'result': bool(test)})
+
+    trace = {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'suite': suite}}
+    write_atomic(path, json.dumps(trace))
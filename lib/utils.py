@@ -1,7 +1,9 @@
 import os
 import logging
+import re
 import signal
 import struct
+import subprocess
 import sys
 import time
 from datetime import datetime
@@ -15,6 +17,12 @@ def setup_logging(format='%(levelname)s: %(message)s'):
      logging.basicConfig(format=format, level=level, stream=sys.stdout)
 
 
+# Marks the start of a phase of a boot or build in its log, parsed by ngci to
+# build a timeline of the run, see timeline.py.
+def phase_marker(name):
+    print(f'## PHASE {name} {time.time():.3f}', flush=True)
+
+
 def timeout_handler(signum, frame):
     logging.error('Timeout ! Exiting')
     sys.exit(1)
@@ -81,7 +89,7 @@ def get_tarball(basename):
         dirs.append(env)
 
     for base in dirs:
-        for suffix in ['gz', 'bz2', 'xz']:
+        for suffix in TARBALL_DECOMPRESSORS:
             name = f'{base}/{basename}.tar.{suffix}'
             if os.path.isfile(name):
                 return name
@@ -89,6 +97,33 @@ def get_tarball(basename):
     return None
 
 
+# How to decompress each tarball format to stdout, in order of preference
+TARBALL_DECOMPRESSORS = {
+    'gz':  'zcat',
+    'zst': 'zstd -dc',
+    'bz2': 'bzcat',
+    'xz':  'xzcat',
+}
+
+def tarball_decompressor(path):
+    for suffix, cmd in TARBALL_DECOMPRESSORS.items():
+        if path.endswith(f'.tar.{suffix}'):
+            return cmd
+
+    # Assume gzip, the historical format
+    return 'zcat'
+
+
+# The suffix of a tarball, eg. '.tar.zst', so a copy of it can keep the
+# format recognisable.
+def tarball_suffix(path):
+    for suffix in TARBALL_DECOMPRESSORS:
+        if path.endswith(f'.tar.{suffix}'):
+            return f'.tar.{suffix}'
+
+    return '.tar.gz'
+
+
 def get_modules_tarball():
     return get_tarball('modules')
 
@@ -215,6 +250,20 @@ def filter_log_warnings(infile, outfile, extra_patterns=[]):
     return found
 
 
+# The GNU build-id of an ELF file, or None if it doesn't have one
+def get_build_id(elf_path):
+    try:
+        output = subprocess.check_output(['readelf', '-n', elf_path], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    m = re.search(r'Build ID: ([0-9a-f]+)', output.decode('utf-8', errors='ignore'))
+    if m:
+        return m.group(1)
+
+    return None
+
+
 def get_endian(elf_path):
     data = open(elf_path, 'rb').read(6)
     vals = struct.unpack('6B', data)